@@ -0,0 +1,157 @@
+import os
+import glob
+import json
+import shutil
+
+import numpy as np
+
+from keypoints import *
+
+
+# fixed layout of a shard, one .npy file per field, every file can be opened with mmap_mode='r'
+# boxes (N, 4), body (N, 18, 3) and hand (N, 42, 3) are per person, image_index (N,) points to the image tables
+# image_size (M, 3) is width, height, depth, names (bytes) and name_offsets (M + 1,) are the file name table
+# image_seed (M,) is the sample seed of every image, -1 if unknown, track_id (N,) is the track of every person, -1 if none
+# shards written before image_seed and track_id were added do not have them
+shard_fields = ['boxes', 'body', 'hand', 'image_index', 'image_size', 'names', 'name_offsets', 'image_seed', 'track_id']
+
+
+# function to convert a person to its bbox (4,), body (18, 3) and hand (42, 3) arrays of (x, y, occ)
+# keypoints missing in the person are nan
+def person_to_arrays(person):
+    body = np.full((len(body_labels), 3), np.nan, dtype=np.float32)
+    hand = np.full((len(hand_bones), 3), np.nan, dtype=np.float32)
+    for arr, points, names in [(body, person.pose, body_labels), (hand, person.hand, hand_bones)]:
+        for i, name in enumerate(names):
+            if name in points: arr[i] = points[name]
+    return np.asarray(person.bbox, dtype=np.float32), body, hand
+
+
+# function to write one shard directory, written to a temporary directory first so a shard is complete or missing
+# failed is the list of source files that could not be read into the shard, kept in meta.json
+def write_shard(shard_dir, boxes, body, hand, image_index, image_size, names, seeds=None, track_ids=None, failed=None):
+    tmp_dir = shard_dir + ".tmp"
+    if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    if seeds is None: seeds = [None] * len(names)
+    if track_ids is None: track_ids = [None] * len(image_index)
+    encoded = [name.encode("utf-8") for name in names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(name) for name in encoded])
+    arrays = {
+        'boxes': np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+        'body': np.asarray(body, dtype=np.float32).reshape(-1, len(body_labels), 3),
+        'hand': np.asarray(hand, dtype=np.float32).reshape(-1, len(hand_bones), 3),
+        'image_index': np.asarray(image_index, dtype=np.int64),
+        'image_size': np.asarray(image_size, dtype=np.int32).reshape(-1, 3),
+        'names': np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        'name_offsets': name_offsets,
+        'image_seed': np.asarray([-1 if seed is None else seed for seed in seeds], dtype=np.int64),
+        'track_id': np.asarray([-1 if track_id is None else track_id for track_id in track_ids], dtype=np.int32),
+    }
+    for field in shard_fields:
+        np.save(os.path.join(tmp_dir, field + ".npy"), arrays[field])
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"persons": len(arrays['boxes']), "images": len(names), "failed": failed or []}, f)
+    # a shard rebuilt to retry its failed files replaces the old one, if this is interrupted the shard is missing
+    if os.path.exists(shard_dir): shutil.rmtree(shard_dir)
+    os.rename(tmp_dir, shard_dir)
+
+
+# function to list the complete shard directories under root
+def list_shards(root):
+    return sorted(
+        path for path in glob.glob(os.path.join(root, "*"))
+        if not path.endswith(".tmp") and os.path.exists(os.path.join(path, "meta.json"))
+    )
+
+
+# function to read the image file names of a shard
+def read_names(shard_dir):
+    names = np.load(os.path.join(shard_dir, "names.npy"), mmap_mode='r')
+    offsets = np.load(os.path.join(shard_dir, "name_offsets.npy"))
+    data = names.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+# writer of fixed layout annotation shards, a shard is written every shard_size images
+# and on flush, if shard_size is None only on flush
+class ArrayShardWriter():
+    def __init__(self, root:str, shard_size:int=10000, prefix:str="shard"):
+        self.root = root
+        self.shard_size = shard_size
+        self.prefix = prefix
+        # continue after the existing shards, never overwrite a shard of an earlier run
+        self.shard = len(list_shards(root))
+        os.makedirs(root, exist_ok=True)
+        self.clear()
+
+    def clear(self):
+        self.boxes, self.body, self.hand, self.image_index, self.track_ids = [], [], [], [], []
+        self.image_size, self.names, self.seeds = [], [], []
+
+    def add(self, objects:list, img_path:str, img_width:int, img_height:int, img_channel:int, seed:int=None):
+        for obj in objects:
+            bbox, body, hand = person_to_arrays(obj)
+            self.boxes.append(bbox)
+            self.body.append(body)
+            self.hand.append(hand)
+            self.image_index.append(len(self.names))
+            self.track_ids.append(obj.track_id)
+        self.image_size.append((img_width, img_height, img_channel))
+        self.names.append(os.path.basename(img_path))
+        self.seeds.append(seed)
+        if self.shard_size is not None and len(self.names) >= self.shard_size: self.flush()
+
+    def flush(self):
+        if not self.names: return
+        shard_dir = os.path.join(self.root, "{}_{:05d}".format(self.prefix, self.shard))
+        write_shard(shard_dir, self.boxes, self.body, self.hand, self.image_index, self.image_size, self.names, self.seeds, self.track_ids)
+        self.shard += 1
+        self.clear()
+
+    def close(self):
+        self.flush()
+
+
+# memory mapped view of every shard under root, nothing is parsed or copied on open
+class ArrayDataset():
+    def __init__(self, root:str):
+        self.shards = []
+        for shard_dir in list_shards(root):
+            self.shards.append({
+                field: np.load(os.path.join(shard_dir, field + ".npy"), mmap_mode='r') for field in shard_fields
+                if os.path.exists(os.path.join(shard_dir, field + ".npy"))
+            })
+        # person offset of every shard
+        self.offsets = np.cumsum([0] + [len(shard['boxes']) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0: idx += len(self)
+        if not 0 <= idx < len(self): raise IndexError(idx)
+        s = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        shard, i = self.shards[s], idx - self.offsets[s]
+        img = int(shard['image_index'][i])
+        start, end = shard['name_offsets'][img], shard['name_offsets'][img + 1]
+        return {
+            "bbox": np.asarray(shard['boxes'][i]),
+            "body": np.asarray(shard['body'][i]),
+            "hand": np.asarray(shard['hand'][i]),
+            "file_name": shard['names'][start:end].tobytes().decode("utf-8"),
+            "size": np.asarray(shard['image_size'][img]),
+            "seed": int(shard['image_seed'][img]) if 'image_seed' in shard else -1,
+            "track_id": int(shard['track_id'][i]) if 'track_id' in shard else -1,
+        }
+
+    # concatenated person field (boxes, body, hand, image_index, track_id) of every shard, this reads the field into memory
+    # image_index is shifted to index the concatenated image tables
+    def field(self, name:str):
+        if not self.shards: return np.empty(0)
+        if name != 'image_index':
+            return np.concatenate([shard[name] for shard in self.shards])
+        image_offsets = np.cumsum([0] + [len(shard['image_size']) for shard in self.shards])
+        return np.concatenate([shard[name] + offset for shard, offset in zip(self.shards, image_offsets)])
@@ -1,46 +1,29 @@
 import os
 import sys
+import json
 import time
 import glob
+import hashlib
 import math
 import random
 
 import bpy
 import bpy_extras
 import numpy as np
-from mathutils import Vector
+from mathutils import Vector, Matrix
+from mathutils.bvhtree import BVHTree
 from bpy_extras.object_utils import world_to_camera_view
 
+from keypoints import *
 
-pose_head = ['nose', 'ear_r', 'ear_l', 'eye_end_r', 'eye_end_l',]
-
-# pose part names
-pose_parts = {
-    'nose': 'Nose',
-    'Neck': 'Neck',
-    'RightArm': 'RightArm', 'RightForeArm': 'RightForeArm', 'RightHand': 'RightHand',
-    'LeftArm': 'LeftArm', 'LeftForeArm': 'LeftForeArm', 'LeftHand': 'LeftHand',
-    'RightUpLeg': 'RightUpLeg', 'RightLeg': 'RightLeg', 'RightFoot': 'RightFoot',
-    'LeftUpLeg': 'LeftUpLeg', 'LeftLeg': 'LeftLeg', 'LeftFoot': 'LeftFoot',
-    'eye_end_r': 'RightEye', 'eye_end_l': 'LeftEye',
-    'ear_r': 'RightEar', 'ear_l': 'LeftEar',
-}
-
-# hands part names
-hand_parts = [
-    'LeftHand',
-    'LeftHandThumb1', 'LeftHandThumb2', 'LeftHandThumb3', 'LeftHandThumb4',
-    'LeftHandIndex1', 'LeftHandIndex2', 'LeftHandIndex3', 'LeftHandIndex4',
-    'LeftHandMiddle1', 'LeftHandMiddle2', 'LeftHandMiddle3', 'LeftHandMiddle4',
-    'LeftHandRing1', 'LeftHandRing2', 'LeftHandRing3', 'LeftHandRing4',
-    'LeftHandPinky1', 'LeftHandPinky2', 'LeftHandPinky3', 'LeftHandPinky4',
-    'RightHand', 
-    'RightHandThumb1', 'RightHandThumb2', 'RightHandThumb3', 'RightHandThumb4',
-    'RightHandIndex1', 'RightHandIndex2', 'RightHandIndex3', 'RightHandIndex4',
-    'RightHandMiddle1', 'RightHandMiddle2', 'RightHandMiddle3', 'RightHandMiddle4',
-    'RightHandRing1', 'RightHandRing2', 'RightHandRing3', 'RightHandRing4',
-    'RightHandPinky1', 'RightHandPinky2', 'RightHandPinky3', 'RightHandPinky4',
-]
+
+# occlusion thresholds, head and hand bones are close to the skin, use a smaller threshold
+body_thresholds = np.array([.005 if name in pose_head or name in hand_parts else .2 for name in body_bones])
+hand_thresholds = np.full(len(hand_bones), .2)
+
+# occlusion backends, scene_raycast casts against the whole scene
+# bvh casts against one bvh tree of all visible meshes built once per frame
+occlusion_backends = ['scene_raycast', 'bvh']
 
 # function to generate file name with timestamp and a random 8 digit number
 # timestamp format: %Y%m%d_%H%M%S
@@ -53,6 +36,24 @@ def generate_file_name(baseFileName=None):
     return baseFileName + '_' + timestamp + '_' + str(random8digit)
 
 
+# function to derive the seed of one sample from the global seed, the worker id and the sample index
+# the seed does not depend on the other samples, so any sample can be generated again on its own
+def sample_seed(seed, worker_id=0, index=0):
+    digest = hashlib.sha256("{}:{}:{}".format(seed, worker_id, index).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") >> 1
+
+
+# function to get the random generator of one sample, pass it as rng to the sampling functions
+def sample_rng(seed, worker_id=0, index=0):
+    return random.Random(sample_seed(seed, worker_id, index))
+
+
+# function to generate the file name of one sample, unique for every (seed, worker id, index)
+# so parallel workers never write the same name
+def sample_name(seed, worker_id=0, index=0):
+    return "s{}_w{:03d}_{:08d}".format(seed, worker_id, index)
+
+
 # function to make object look at the given point
 def look_at(obj_name=None, point=Vector((0, 0, 0))):
     if obj_name is None:
@@ -67,34 +68,137 @@ def look_at(obj_name=None, point=Vector((0, 0, 0))):
     return rot
 
 
-def random_camera(camera=None, dst_point=Vector((0,0,0)), pos_scale=.5, offset_scope=0.0, min_distance=0.25, max_distance=2.5):
+def random_camera(camera=None, dst_point=Vector((0,0,0)), pos_scale=.5, offset_scope=0.0, min_distance=0.25, max_distance=2.5, rng=random):
     x, y, z = dst_point
     if camera is None: camera = bpy.context.scene.camera
     # set camera position
     camera.location = Vector((
-        random.uniform(x-pos_scale, x+pos_scale),
-        random.uniform(y-0.75*pos_scale, y-1.5*pos_scale),
-        random.uniform(z-pos_scale, z+pos_scale)
+        rng.uniform(x-pos_scale, x+pos_scale),
+        rng.uniform(y-0.75*pos_scale, y-1.5*pos_scale),
+        rng.uniform(z-pos_scale, z+pos_scale)
     ))
     # random point to look at
     point = Vector((
-        random.uniform(x - offset_scope, x + offset_scope),
+        rng.uniform(x - offset_scope, x + offset_scope),
         y,
-        random.uniform(z - offset_scope, z + offset_scope)
+        rng.uniform(z - offset_scope, z + offset_scope)
     ))
     # set camera rotation
     rot_quat = look_at('Camera', point)
 
     # set distance
-    distance = random.uniform(min_distance, max_distance)
+    distance = rng.uniform(min_distance, max_distance)
     camera.location = point + rot_quat @ Vector((0.0, 0.0, distance))
 
     # enable camera depth of field and set distance
     camera.data.dof.use_dof = True
-    camera.data.dof.focus_distance = random.uniform(0.5*distance, distance)
+    camera.data.dof.focus_distance = rng.uniform(0.5*distance, distance)
 
 
-def random_light(light_list=[], target_origin=Vector((0,0,0)), scope=0.0, power_scope=[250, 750]):
+# function to sample n camera poses at once with the distribution of random_camera
+# return locations (n, 3), world rotation matrices (n, 3, 3) and distances to the look at point (n,)
+def sample_camera_candidates(dst_point, n=64, pos_scale=.5, offset_scope=0.0, min_distance=0.25, max_distance=2.5, rng=random):
+    gen = np.random.default_rng(rng.getrandbits(64))
+    # like random.uniform, low may be larger than high
+    def uniform(low, high):
+        return low + (high - low) * gen.random(n)
+
+    x, y, z = dst_point
+    start = np.stack((
+        uniform(x - pos_scale, x + pos_scale),
+        uniform(y - 0.75 * pos_scale, y - 1.5 * pos_scale),
+        uniform(z - pos_scale, z + pos_scale),
+    ), axis=1)
+    point = np.stack((
+        uniform(x - offset_scope, x + offset_scope),
+        np.full(n, float(y)),
+        uniform(z - offset_scope, z + offset_scope),
+    ), axis=1)
+
+    # same as look_at, the camera -Z axis points at the point and its Y axis is as close as possible to world Z
+    forward = point - start
+    forward /= np.linalg.norm(forward, axis=1, keepdims=True)
+    z_axis = -forward
+    y_axis = np.array([0.0, 0.0, 1.0]) - z_axis[:, 2:3] * z_axis
+    y_axis /= np.linalg.norm(y_axis, axis=1, keepdims=True)
+    x_axis = np.cross(y_axis, z_axis)
+    rotations = np.stack((x_axis, y_axis, z_axis), axis=2)
+
+    distances = uniform(min_distance, max_distance)
+    locations = point + z_axis * distances[:, None]
+    return locations, rotations, distances
+
+
+# function to project world space coordinates (M, 3) with n camera poses at once, like world_to_camera_view_np
+# return (n, M, 3) of normalized x, y and depth z
+def project_candidates(scene, camera, locations, rotations, coords):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    # camera space, rotations are orthonormal so the inverse is the transpose
+    co_local = np.einsum('nji,nmj->nmi', rotations, coords[None, :, :] - locations[:, None, :])
+    z = -co_local[..., 2]
+    frame = np.array([tuple(v) for v in camera.data.view_frame(scene=scene)[:3]], dtype=np.float64)
+    scale = z / -frame[0, 2] if camera.data.type != 'ORTHO' else np.ones_like(z)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (co_local[..., 0] - frame[2, 0] * scale) / ((frame[1, 0] - frame[2, 0]) * scale)
+        y = (co_local[..., 1] - frame[1, 1] * scale) / ((frame[0, 1] - frame[1, 1]) * scale)
+    return np.stack((x, y, z), axis=-1)
+
+
+# function to score n camera poses against the keypoints (K, 3) and mesh coordinates (M, 3) of one person
+# coverage: fraction of the keypoints in view, truncation: fraction of the bbox outside of the frame
+# area: normalized area of the bbox inside the frame
+def score_candidates(scene, camera, locations, rotations, keypoints, coords):
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    keypoints = keypoints[~np.isnan(keypoints).any(axis=1)]
+    kp = project_candidates(scene, camera, locations, rotations, keypoints)
+    in_view = (kp[..., 2] > 0) & (kp[..., 0] >= 0) & (kp[..., 0] <= 1) & (kp[..., 1] >= 0) & (kp[..., 1] <= 1)
+    coverage = in_view.mean(axis=1) if len(keypoints) else np.zeros(len(locations))
+
+    co = project_candidates(scene, camera, locations, rotations, coords)
+    x, y = co[..., 0], co[..., 1]
+    # a person partly behind the camera is truncated, do not measure the bbox of its projection
+    behind = (co[..., 2] <= 0).any(axis=1)
+    x1, x2, y1, y2 = x.min(axis=1), x.max(axis=1), y.min(axis=1), y.max(axis=1)
+    full = (x2 - x1) * (y2 - y1)
+    area = np.clip(np.minimum(x2, 1) - np.maximum(x1, 0), 0, None) * np.clip(np.minimum(y2, 1) - np.maximum(y1, 0), 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        truncation = np.where(behind | (full <= 0), 1.0, 1 - area / full)
+    area = np.where(behind, 0.0, area)
+    return coverage, truncation, area
+
+
+# function to place the camera at the best of n candidate poses around dst_point that frames one person
+# keypoints (K, 3) and mesh coordinates coords (M, 3) of the person in world space
+# candidates with coverage >= min_coverage, truncation <= max_truncation and area in area_range are feasible
+# the feasible candidate closest to a target area drawn uniformly from area_range is used
+# without a feasible candidate the one with the highest coverage and lowest truncation is used
+# return True if the used candidate is feasible
+def framed_camera(keypoints, coords, camera=None, dst_point=Vector((0,0,0)), n=64, min_coverage=.8, max_truncation=.1,
+                  area_range=(.05, .5), pos_scale=.5, offset_scope=0.0, min_distance=0.25, max_distance=2.5, rng=random):
+    if camera is None: camera = bpy.context.scene.camera
+    scene = bpy.context.scene
+    locations, rotations, distances = sample_camera_candidates(dst_point, n, pos_scale, offset_scope, min_distance, max_distance, rng)
+    # a few thousand vertices are enough for the bbox
+    coords = np.asarray(coords, dtype=np.float64)
+    coords = coords[::max(1, len(coords) // 2000)]
+    coverage, truncation, area = score_candidates(scene, camera, locations, rotations, keypoints, coords)
+
+    feasible = (coverage >= min_coverage) & (truncation <= max_truncation) & (area >= area_range[0]) & (area <= area_range[1])
+    target = rng.uniform(area_range[0], area_range[1])
+    if feasible.any():
+        best = int(np.argmin(np.where(feasible, np.abs(area - target), np.inf)))
+    else:
+        best = int(np.argmax(coverage - truncation))
+
+    camera.location = Vector(locations[best].tolist())
+    camera.rotation_euler = Matrix(rotations[best].tolist()).to_euler()
+    # enable camera depth of field and set distance
+    camera.data.dof.use_dof = True
+    camera.data.dof.focus_distance = rng.uniform(0.5 * distances[best], distances[best])
+    return bool(feasible[best])
+
+
+def random_light(light_list=[], target_origin=Vector((0,0,0)), scope=0.0, power_scope=[250, 750], rng=random):
     # list all lights in scene
     if len(light_list) == 0:
         for i in list_objects():
@@ -105,14 +209,14 @@ def random_light(light_list=[], target_origin=Vector((0,0,0)), scope=0.0, power_
     for light in light_list:
         # random light postion
         light.location = Vector((
-            random.uniform(target_origin[0] - scope, target_origin[0] + scope),
-            random.uniform(target_origin[1] - scope, target_origin[1] + scope),
-            random.uniform(target_origin[2] - scope, target_origin[2] + scope)
+            rng.uniform(target_origin[0] - scope, target_origin[0] + scope),
+            rng.uniform(target_origin[1] - scope, target_origin[1] + scope),
+            rng.uniform(target_origin[2] - scope, target_origin[2] + scope)
         ))
-        light.data.energy = random.uniform(power_scope[0], power_scope[1])
-        light.data.color = (random.uniform(0.5, 1.5), random.uniform(0.5, 1.5), random.uniform(0.5, 1.5))
+        light.data.energy = rng.uniform(power_scope[0], power_scope[1])
+        light.data.color = (rng.uniform(0.5, 1.5), rng.uniform(0.5, 1.5), rng.uniform(0.5, 1.5))
         # radius
-        light.data.shadow_soft_size = random.uniform(1.0, 2.5)
+        light.data.shadow_soft_size = rng.uniform(1.0, 2.5)
 
 
 # border_data = [xmin, ymin, xmax, ymax]
@@ -142,11 +246,14 @@ def fast_render(file_prefix, image_dir='./', width=512, height=512, border_data=
 
 # function to convert world space coordinates to camera space coordinates 2d
 # normalized return value is in range [0, 1] if clamp is True
-def to_camera_space_2d(vector, camera=None, clamp=True):
-    if camera is None:
-        camera = bpy.context.scene.camera
-
-    co = world_to_camera_view(bpy.context.scene, camera, vector)
+# ctx: FrameContext, project with its camera instead of reading the camera again
+def to_camera_space_2d(vector, camera=None, clamp=True, ctx=None):
+    if ctx is not None:
+        co = Vector(ctx.project([tuple(vector)])[0].tolist())
+    else:
+        if camera is None:
+            camera = bpy.context.scene.camera
+        co = world_to_camera_view(bpy.context.scene, camera, vector)
     # flip y axis
     co.y = 1 - co.y
     if clamp:
@@ -157,9 +264,94 @@ def to_camera_space_2d(vector, camera=None, clamp=True):
     return (round(co.x, 6), round(co.y, 6))
 
 
+# function to read what world_to_camera_view_np needs of a camera
+# return the (4, 4) world to camera matrix, the (4, 3) corners of the camera frame and True for an ortho camera
+def camera_projection(scene, camera):
+    matrix = np.array(camera.matrix_world.normalized().inverted(), dtype=np.float64)
+    # top right, bottom right, bottom left, top left corners of the camera frame
+    frame = np.array([tuple(v) for v in camera.data.view_frame(scene=scene)], dtype=np.float64)
+    return matrix, frame, camera.data.type == 'ORTHO'
+
+
+# numpy version of world_to_camera_view for an (N, 3) array of world space coordinates
+# return (N, 3) array of (x, y, z), x and y are normalized, z is the distance along the view axis
+def world_to_camera_view_np(scene, camera, coords):
+    return project_view(coords, *camera_projection(scene, camera))
+
+
+# world_to_camera_view_np with the camera read by camera_projection
+def project_view(coords, matrix, frame, ortho):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    co_local = coords @ matrix[:3, :3].T + matrix[:3, 3]
+    z = -co_local[:, 2]
+
+    if not ortho:
+        # perspective division, scale the frame to the depth of every vertex
+        scale = z / -frame[0, 2]
+        min_x, max_x = frame[2, 0] * scale, frame[1, 0] * scale
+        min_y, max_y = frame[1, 1] * scale, frame[0, 1] * scale
+    else:
+        min_x, max_x = frame[2, 0], frame[1, 0]
+        min_y, max_y = frame[1, 1], frame[0, 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (co_local[:, 0] - min_x) / (max_x - min_x)
+        y = (co_local[:, 1] - min_y) / (max_y - min_y)
+
+    if not ortho:
+        # same as world_to_camera_view for points on the camera plane
+        x[z == 0.0] = 0.5
+        y[z == 0.0] = 0.5
+    return np.stack((x, y, z), axis=1)
+
+
+# function to read the evaluated mesh vertices of an object into an (N, 3) array in world space
+def get_mesh_coords_world(obj_name, dg=None):
+    if dg is None: dg = bpy.context.evaluated_depsgraph_get()
+    mesh_object = bpy.data.objects[obj_name]
+    eval_object = mesh_object.evaluated_get(dg)
+    mesh = eval_object.to_mesh()
+    # bulk read the vertex coordinates instead of looping over mesh.vertices
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    # Free the memory used by the mesh
+    eval_object.to_mesh_clear()
+
+    matrix = np.array(mesh_object.matrix_world, dtype=np.float64)
+    co = co.reshape(-1, 3).astype(np.float64)
+    return co @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+# function to get bounding box in camera space from an (N, 3) array of world space coordinates
+# return None if none of the coordinates is in view
+def get_bounding_box_2d_from_coords(coords, camera=None, ctx=None):
+    if ctx is not None:
+        co = ctx.project(coords)
+    else:
+        if camera is None: camera = bpy.context.scene.camera
+        co = world_to_camera_view_np(bpy.context.scene, camera, coords)
+    x, y, z = co[:, 0], co[:, 1], co[:, 2]
+    # keep the vertices in front of the camera and inside the frame
+    in_view = (z > 0.0) & (x >= 0.0) & (x <= 1.0) & (y >= 0.0) & (y <= 1.0)
+    if not in_view.any(): return None
+
+    x, y = x[in_view], 1 - y[in_view]
+    # return the result
+    return [round(float(x.min()), 6), round(float(y.min()), 6), round(float(x.max()), 6), round(float(y.max()), 6)]
+
+
 # function to get object bounding box in camera space
-# normalized return value is in range [0, 1] if clamp is True
-def get_bounding_box_2d(obj_name, camera=None):
+# normalized return value is in range [0, 1], None if the mesh is not in view
+# ctx: FrameContext, the evaluated mesh is read once per pose and projected with its camera
+def get_bounding_box_2d(obj_name, camera=None, ctx=None):
+    if ctx is not None:
+        return get_bounding_box_2d_from_coords(ctx.mesh_coords(obj_name), ctx=ctx)
+    if camera is None: camera = bpy.context.scene.camera
+    return get_bounding_box_2d_from_coords(get_mesh_coords_world(obj_name), camera)
+
+
+# per-vertex python loop version of get_bounding_box_2d, kept as reference for benchmark.py
+def get_bounding_box_2d_legacy(obj_name, camera=None):
     if camera is None: camera = bpy.context.scene.camera
     # Get the inverse transformation matrix
     matrix = camera.matrix_world.normalized().inverted()
@@ -209,14 +401,14 @@ def get_bounding_box_2d(obj_name, camera=None):
 
 
 # function to get object bounding box
-def get_bounding_box_3d(obj_name, camera=None):
+def get_bounding_box_3d(obj_name, camera=None, ctx=None):
     if camera is None: camera = bpy.context.scene.camera
     # get object bounding box
     obj = bpy.data.objects[obj_name]
     # get bounding box
     bbox = [obj.matrix_world @ Vector(corner) for corner in obj.bound_box]
     # convert to camera space
-    _bbox = [to_camera_space_2d(vector, camera) for vector in bbox]
+    _bbox = [to_camera_space_2d(vector, camera, ctx=ctx) for vector in bbox]
     # convert Vector to numpy array
     _bbox = np.array([np.array(vector) for vector in _bbox])
     # flip y axis
@@ -249,7 +441,7 @@ def load_animation(filepath):
         automatic_bone_orientation=False,
     )
     # rename the fbx to the file name
-    fbx_name = filepath.split("\\")[-1].split(".")[0]
+    fbx_name = os.path.splitext(os.path.basename(filepath))[0]
     # delete same name animation if exists
     if fbx_name in bpy.data.actions:
         bpy.data.actions.remove(bpy.data.actions[fbx_name])
@@ -262,17 +454,71 @@ def load_animation(filepath):
 
 
 # function to load all animations in a directory
-def load_animations(dir_path):
+# if cache_dir is given, every fbx is imported once into its own library .blend in cache_dir
+# and later runs append the action from the library, until the fbx path, mtime or size changes
+def load_animations(dir_path, cache_dir=None):
     # delete all animations
     for anim in bpy.data.actions:
         bpy.data.actions.remove(anim)
     anims = []
-    for file in os.listdir(dir_path):
+    for file in sorted(os.listdir(dir_path)):
         if file.endswith(".fbx"):
-            anims.append(load_animation(os.path.join(dir_path, file)))
+            if cache_dir is None:
+                anims.append(load_animation(os.path.join(dir_path, file)))
+            else:
+                anims.append(load_cached_animation(os.path.join(dir_path, file), cache_dir))
     return anims
 
 
+# function to read the animation cache index, {fbx path: {mtime, size, action, library}}
+def read_animation_cache(cache_dir):
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path): return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def write_animation_cache(cache_dir, index):
+    index_path = os.path.join(cache_dir, "index.json")
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+
+
+# function to load one fbx animation through the library cache
+def load_cached_animation(filepath, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    index = read_animation_cache(cache_dir)
+    entry = index.get(filepath)
+
+    if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        library = os.path.join(cache_dir, entry["library"])
+        if os.path.exists(library):
+            # append the action from the library, no fbx import
+            with bpy.data.libraries.load(library, link=False) as (data_from, data_to):
+                data_to.actions = [name for name in data_from.actions if name == entry["action"]]
+            if data_to.actions and data_to.actions[0] is not None:
+                action = data_to.actions[0]
+                action.use_fake_user = False
+                return action.name
+
+    # import the fbx and write its action into the library
+    fbx_name = load_animation(filepath)
+    library_name = fbx_name + ".blend"
+    bpy.data.libraries.write(os.path.join(cache_dir, library_name), {bpy.data.actions[fbx_name]}, fake_user=True)
+    index = read_animation_cache(cache_dir)
+    index[filepath] = {
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "action": fbx_name,
+        "library": library_name,
+    }
+    write_animation_cache(cache_dir, index)
+    return fbx_name
+
+
 # function to apply animation to object's bones
 def apply_animation(anim_name, obj_name):
     # if the object has no animation, create an empty animation
@@ -285,38 +531,139 @@ def apply_animation(anim_name, obj_name):
     bpy.data.objects[obj_name].animation_data.action = bpy.data.actions[anim_name]
     # apply animation to object
     bpy.ops.nla.bake(frame_start=0, frame_end=0, only_selected=False, visual_keying=True, clear_constraints=False, use_current_action=True, bake_types={'POSE'})
+    invalidate_frame_context()
 
 
 # function to random animation to all armature objects in the scene
-def random_animation():
+def random_animation(anims=None, rng=random):
+    # get all animations
+    if anims is None: anims = list_animations()
     for obj in list_armatures(True):
-        # get all animations
-        anims = list_animations()
         # random animation
-        anim = random.choice(anims)
+        anim = rng.choice(anims)
         # apply animation to object
         apply_animation(anim, obj.name)
 
 
 # function to set random armature position via given armature name
-def random_armature_position(scope=2.5, rotate_scope=30, scale_scope=.5):
+def random_armature_position(scope=2.5, rotate_scope=30, scale_scope=.5, rng=random):
     for obj in list_armatures(True):
         # randomize position
-        obj.location = (random.uniform(-scope, scope), random.uniform(-scope, scope), obj.location.z)
+        obj.location = (rng.uniform(-scope, scope), rng.uniform(-scope, scope), obj.location.z)
         # obj.rotation_euler = (0, 0, random.uniform(-rotate_scope, rotate_scope))
         # _scale = random.uniform(1 - scale_scope, 1 + scale_scope)
         # obj.scale = (_scale, _scale, _scale)
-        bpy.ops.object.transform_apply(location=True, rotation=False, scale=False)
+    invalidate_frame_context()
+
+
+# grid spatial hash of circular footprints on the ground plane
+# the cell size is twice the largest radius, so a footprint can only touch the footprints of its 3x3 neighbor cells
+class SpatialHash():
+    def __init__(self, max_radius):
+        self.max_radius = max_radius
+        self.cell = 2 * max_radius
+        self.cells = {}
+
+    def key(self, x, y):
+        return (math.floor(x / self.cell), math.floor(y / self.cell))
+
+    def collides(self, x, y, radius):
+        i, j = self.key(x, y)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for ox, oy, o_radius in self.cells.get((i + di, j + dj), []):
+                    if (x - ox) ** 2 + (y - oy) ** 2 < (radius + o_radius) ** 2: return True
+        return False
+
+    def add(self, x, y, radius):
+        if radius > self.max_radius:
+            raise ValueError("footprint radius {} is larger than the max radius {}".format(radius, self.max_radius))
+        self.cells.setdefault(self.key(x, y), []).append((x, y, radius))
+
+
+# function to get the ground plane footprint radius of an armature from the local bounding boxes of its meshes
+# the half diagonal is used, so the footprints do not overlap in any rotation
+def footprint_radius(arma):
+    radius = 0.0
+    for child in arma.children:
+        if child.type != 'MESH': continue
+        corners = np.array([tuple(corner) for corner in child.bound_box], dtype=np.float64)
+        half = (corners.max(axis=0) - corners.min(axis=0))[:2] / 2 * np.array(child.scale[:2]) * np.array(arma.scale[:2])
+        radius = max(radius, float(np.linalg.norm(half)))
+    return radius
+
+
+# function to scatter the armatures on the ground plane without overlapping footprints, in random order
+# every armature gets a random position in [-scope, scope] and, if rotate, a random rotation around z
+# an armature without free position after max_tries is hidden, return the placed armatures
+def place_crowd(armas=None, scope=2.5, max_tries=30, rotate=False, min_radius=.2, rng=random):
+    if armas is None: armas = list_armatures(visible_only=True)
+    armas = list(armas)
+    rng.shuffle(armas)
+    radii = [max(min_radius, footprint_radius(arma)) for arma in armas]
+    grid = SpatialHash(max(radii) if radii else min_radius)
+    placed = []
+    for arma, radius in zip(armas, radii):
+        for _ in range(max_tries):
+            x, y = rng.uniform(-scope, scope), rng.uniform(-scope, scope)
+            if grid.collides(x, y, radius): continue
+            grid.add(x, y, radius)
+            arma.location = (x, y, arma.location.z)
+            if rotate: arma.rotation_euler = (arma.rotation_euler.x, arma.rotation_euler.y, rng.uniform(-math.pi, math.pi))
+            placed.append(arma)
+            break
+        else:
+            set_armature_visible(arma, False)
+    invalidate_frame_context()
+    return placed
+
+
+# function to show or hide an armature and its meshes
+def set_armature_visible(arma, visible):
+    for obj in [arma] + list(arma.children):
+        obj.hide_viewport = not visible
+        obj.hide_render = not visible
+    invalidate_frame_context()
+
+
+# function to make a linked duplicate of an armature and its meshes, the armature and mesh data are shared
+# the duplicate has its own pose, its armature modifiers deform with the duplicate armature
+# its meshes get a new pass index, the instance id of the single pass mask
+def duplicate_armature(arma, collection=None):
+    if collection is None: collection = arma.users_collection[0]
+    pass_index = max([obj.pass_index for obj in bpy.data.objects if obj.type == 'MESH'] + [0]) + 1
+    new_arma = arma.copy()
+    new_arma["crowd_source"] = arma.name
+    collection.objects.link(new_arma)
+    for child in arma.children:
+        new_child = child.copy()
+        new_child.parent = new_arma
+        if new_child.type == 'MESH': new_child.pass_index = pass_index
+        for modifier in new_child.modifiers:
+            if modifier.type == 'ARMATURE' and modifier.object == arma: modifier.object = new_arma
+        for child_collection in child.users_collection:
+            child_collection.objects.link(new_child)
+    return new_arma
+
+
+# function to show num random armatures, linked duplicates are added while the scene has less than num armatures
+# the duplicates are kept for the next crowds, return the shown armatures
+def show_crowd(num, rng=random):
+    armas = list_armatures(visible_only=False)
+    sources = [arma for arma in armas if "crowd_source" not in arma]
+    for i in range(num - len(armas)):
+        duplicate_armature(sources[i % len(sources)])
+    return show_armature(num, rng)
 
 
 # function to frame the animation via given frame number
-def set_frame(anim_name, obj_name, frame_num=None):
+def set_frame(anim_name, obj_name, frame_num=None, rng=random):
     action = bpy.data.actions[anim_name]
     # select the animation
     bpy.data.objects[obj_name].animation_data.action = action
     # if frame number is not given, randomize it
     if frame_num is None or frame_num == -1:
-        frame_num = random.randint(action.frame_range[0]+2, action.frame_range[1])
+        frame_num = rng.randint(action.frame_range[0]+2, action.frame_range[1])
     # check if frame number is in range
     if frame_num > action.frame_range[1]:
         frame_num = action.frame_range[1]
@@ -324,13 +671,14 @@ def set_frame(anim_name, obj_name, frame_num=None):
         frame_num = action.frame_range[0]
     # set the frame
     bpy.context.scene.frame_set(frame_num)
+    invalidate_frame_context()
     return frame_num
 
 
 # function to set animation frame to every visible armature's action
-def set_frame_all(frame_num=None):
+def set_frame_all(frame_num=None, rng=random):
     for obj in list_armatures(visible_only=True):
-        set_frame(obj.animation_data.action.name, obj.name, frame_num)
+        set_frame(obj.animation_data.action.name, obj.name, frame_num, rng)
 
 
 # function to list objects in scene
@@ -346,7 +694,10 @@ def list_animations():
     return anim_list
 
 
-def list_armatures(visible_only=True):
+# ctx: FrameContext, its visible armatures are listed once per pose
+def list_armatures(visible_only=True, ctx=None):
+    if visible_only and ctx is not None:
+        return list(ctx.armatures)
     if visible_only:
         return [obj for obj in bpy.data.objects if obj.type == 'ARMATURE' and obj.visible_get()]
     return [obj for obj in bpy.data.objects if obj.type == 'ARMATURE']
@@ -386,50 +737,91 @@ def get_bone_pos(bone_name):
     return target_bone_pos
 
 
-# function to list hands bones
-def get_hand_to_dict(obj_name, camera=None):
-    if camera is None:
-        camera = bpy.data.objects['Camera']
-    hand_bone_dict = {}
-    aram = bpy.data.objects[obj_name]
-    for bone in aram.pose.bones:
-        if bone.name in hand_parts:
-            # get the bone position (world space)
-            x, y = to_camera_space_2d(bone.matrix.to_translation(), clamp=False)
-            boneVec = get_bone_pos_global(aram, bone.name)
-            occ = is_occluded(camera, boneVec)
-            # convert true/false to 1/0
-            occ = 1 if occ else 0
-            hand_bone_dict[bone.name] = (x, y, occ)
-    return hand_bone_dict
+# function to read the world space head position of every bone of an armature in one pass
+# return {bone name: row} and (B, 3) array
+def get_heads_world(arma):
+    bones = arma.pose.bones
+    heads = np.empty(len(bones) * 3, dtype=np.float32)
+    bones.foreach_get('head', heads)
+    heads = heads.reshape(-1, 3).astype(np.float64)
+    matrix = np.array(arma.matrix_world, dtype=np.float64)
+    return {name: i for i, name in enumerate(bones.keys())}, heads @ matrix[:3, :3].T + matrix[:3, 3]
 
 
-# function to list pose bones
-def get_pose_to_dict(obj_name, camera=None):
+# function to pick the given bones of get_heads_world, return (K, 3) array, rows of bones missing in the armature are nan
+def select_bones(index, heads, bone_names):
+    co = np.full((len(bone_names), 3), np.nan)
+    rows = [k for k, name in enumerate(bone_names) if name in index]
+    co[rows] = heads[[index[bone_names[k]] for k in rows]]
+    return co
+
+
+# function to gather the world space head position of the given bones of an armature in one pass
+# return (K, 3) array, rows of bones missing in the armature are nan
+def get_bones_world(arma, bone_names):
+    return select_bones(*get_heads_world(arma), bone_names)
+
+
+# function to get pose and hand keypoints of every given armature with one projection and one occlusion pass
+# return {armature name: (body (18, 3) array, hand (42, 3) array)} of (x, y, occ)
+# rows follow body_bones and hand_bones, x and y of bones missing in the armature are nan
+# tree: bvh tree of the bvh backend, pass it to reuse one tree for many cameras of the same pose
+# ctx: FrameContext, its armatures, bone positions, bvh tree and camera are used, camera is ignored
+def get_keypoints(arma_list=None, camera=None, backend='scene_raycast', tree=None, ctx=None):
+    if arma_list is None:
+        arma_list = list_armatures(visible_only=True, ctx=ctx)
     if camera is None:
         camera = bpy.data.objects['Camera']
+    scene = bpy.context.scene
 
-    pose_bone_dict = {}
-    aram = bpy.data.objects[obj_name]
-
-    for bone in aram.pose.bones:
-        if bone.name in pose_parts.keys():
-            # get the bone position (world space)
-            x, y = to_camera_space_2d(bone.matrix.to_translation(), clamp=False)
-            boneVec = get_bone_pos_global(aram, bone.name)
-            # if bone.name not in pose_head:
-            if bone.name in pose_head:
-                print(bone.name, "===============")
-                occ = is_occluded(camera, boneVec, .005)
-            elif bone.name in hand_parts:
-                occ = is_occluded(camera, boneVec, .005)
-            else:
-                occ = is_occluded(camera, boneVec)
-            # convert true/false to 1/0
-            occ = 1 if occ else 0
-            pose_bone_dict[pose_parts[bone.name]] = (x, y, occ)
+    bone_names = body_bones + hand_bones
+    if ctx is not None:
+        bones = [ctx.bones_world(aram, bone_names) for aram in arma_list]
+    else:
+        bones = [get_bones_world(aram, bone_names) for aram in arma_list]
+    coords = np.concatenate(bones + [np.empty((0, 3))])
+    thresholds = np.tile(np.concatenate([body_thresholds, hand_thresholds]), len(arma_list))
+    found = ~np.isnan(coords).any(axis=1)
+
+    occluded = np.ones(len(coords), dtype=bool)
+    occluded[found] = is_occluded_batch(camera, coords[found], thresholds[found], backend=backend, tree=tree, ctx=ctx)
+    # project with the scene camera, flip y axis and keep 6 decimal places like to_camera_space_2d
+    co = ctx.project(coords) if ctx is not None else world_to_camera_view_np(scene, scene.camera, coords)
+    keypoints = np.stack((np.round(co[:, 0], 6), np.round(1 - co[:, 1], 6), occluded.astype(np.float64)), axis=1)
+
+    result = {}
+    for i, aram in enumerate(arma_list):
+        kp = keypoints[i * len(bone_names):(i + 1) * len(bone_names)]
+        result[aram.name] = (kp[:len(body_bones)], kp[len(body_bones):])
+    return result
+
+
+# function to convert a (K, 3) keypoint array to {label: (x, y, occ)}, missing keypoints are skipped
+def keypoints_to_dict(keypoints, labels):
+    return {
+        label: (float(x), float(y), int(occ))
+        for label, (x, y, occ) in zip(labels, keypoints) if not np.isnan(x)
+    }
+
+
+# function to get pose and hand keypoints of every given armature with one occlusion pass
+# return {armature name: (pose dict, hand dict)}, dict values are (x, y, occ)
+def get_keypoints_to_dict(arma_list=None, camera=None, backend='scene_raycast', tree=None, ctx=None):
+    keypoints = get_keypoints(arma_list, camera, backend, tree, ctx)
+    return {
+        name: (keypoints_to_dict(body, body_labels), keypoints_to_dict(hand, hand_bones))
+        for name, (body, hand) in keypoints.items()
+    }
 
-    return pose_bone_dict
+
+# function to list hands bones
+def get_hand_to_dict(obj_name, camera=None):
+    return get_keypoints_to_dict([bpy.data.objects[obj_name]], camera)[obj_name][1]
+
+
+# function to list pose bones
+def get_pose_to_dict(obj_name, camera=None):
+    return get_keypoints_to_dict([bpy.data.objects[obj_name]], camera)[obj_name][0]
 
 
 # function to list all .fbx file names via given directory and file extension
@@ -452,10 +844,11 @@ def hide_armature():
         if obj.parent is not None and obj.parent.type == "ARMATURE":
             obj.hide_viewport = True
             obj.hide_render = True
+    invalidate_frame_context()
 
 
 # function to hide all armature objects in the scene, but random pick one to show and show its mesh
-def show_armature(num=None):
+def show_armature(num=None, rng=random):
     random_armature = []
     # hide all armature objects
     hide_armature()
@@ -463,7 +856,7 @@ def show_armature(num=None):
     # list all armature objects
     if num is None: num = 1
     arma_list = list_armatures(False)
-    random_armature = random.sample(arma_list, num)
+    random_armature = rng.sample(arma_list, num)
 
     for arms in random_armature:
         bpy.data.objects[arms.name].hide_viewport = False
@@ -472,6 +865,7 @@ def show_armature(num=None):
         for child in bpy.data.objects[arms.name].children:
             child.hide_viewport = False
             child.hide_render = False
+    invalidate_frame_context()
 
     return random_armature
 
@@ -483,12 +877,12 @@ def get_obj_from_armature(armature):
 # hdrs function
 def load_hdrs(directory=None):
     # clear all images which start with 'env'
-    for img in bpy.data.images:
+    for img in list(bpy.data.images):
         if img.name.startswith('env'):
             bpy.data.images.remove(img)
 
     if directory is None:
-        os.path.join(os.path.dirname(bpy.data.filepath), "hdrs")
+        directory = os.path.join(os.path.dirname(bpy.data.filepath), "hdrs")
 
     # load it in blender and rename it using basename
     for hdr in glob.glob(os.path.join(directory, "*.*")):
@@ -499,15 +893,68 @@ def set_hdr(hdr_name):
     bpy.data.worlds['World'].node_tree.nodes['Environment Texture'].image = hdr_name
 
 
-def random_hdr():
+def random_hdr(manager=None, rng=random):
+    if manager is not None:
+        manager.random(rng)
+        return
     # list all images which start with 'env'
     hdr_list = [img for img in bpy.data.images if img.name.startswith('env')]
-    set_hdr(random.choice(hdr_list))
+    set_hdr(rng.choice(hdr_list))
+
+
+# lazy hdr manager, the hdr paths are registered without decoding the images
+# an image is loaded on first use and the least recently used images are removed above budget_mb
+class HdrManager():
+    def __init__(self, directory=None, budget_mb=1024):
+        if directory is None:
+            directory = os.path.join(os.path.dirname(bpy.data.filepath), "hdrs")
+        # clear all images which start with 'env', they are loaded again on use
+        for img in list(bpy.data.images):
+            if img.name.startswith('env'):
+                bpy.data.images.remove(img)
+        self.paths = {os.path.basename(path): path for path in sorted(glob.glob(os.path.join(directory, "*.*")))}
+        self.budget = budget_mb * 1024 * 1024
+        # loaded images, least recently used first
+        self.loaded = {}
+        self.current = None
+
+    # estimated memory of a loaded image, hdr images are decoded to float rgba
+    def image_bytes(self, image):
+        width, height = image.size
+        return width * height * 4 * (4 if image.is_float else 1)
+
+    def memory(self):
+        return sum(self.image_bytes(image) for image in self.loaded.values())
+
+    def get(self, name):
+        if name in self.loaded:
+            # move to the most recently used end
+            self.loaded[name] = self.loaded.pop(name)
+        else:
+            self.loaded[name] = bpy.data.images.load(self.paths[name], check_existing=True)
+        return self.loaded[name]
+
+    # remove the least recently used images until the loaded images fit the budget, the current one is kept
+    def evict(self):
+        for name in list(self.loaded):
+            if self.memory() <= self.budget: break
+            if name == self.current: continue
+            bpy.data.images.remove(self.loaded.pop(name))
+
+    def set(self, name):
+        set_hdr(self.get(name))
+        self.current = name
+        self.evict()
+
+    def random(self, rng=random):
+        self.set(rng.choice(list(self.paths)))
 
 
 # only for testing
 # function to get bone position in camera view using view3d_utils
-def get_bone_pos_global(armature, bone_name):
+def get_bone_pos_global(armature, bone_name, ctx=None):
+    if ctx is not None:
+        return Vector(ctx.bones_world(armature, [bone_name])[0].tolist())
     bone = armature.pose.bones[bone_name]
     return armature.matrix_world @ bone.head
 
@@ -527,28 +974,108 @@ def occlusion_ray(scene, dg, origin, direction, distance=1000):
         return is_hit, None, None
 
 
-def is_occluded(camera, boneVec, threshold=.2):
-    scene = bpy.context.scene
+def is_occluded(camera, boneVec, threshold=.2, ctx=None):
+    return bool(is_occluded_batch(camera, [boneVec], threshold, ctx=ctx)[0])
+
+
+# function to get the ray direction from the camera to every world space point
+def camera_ray_directions(scene, camera, coords, ctx=None):
+    if ctx is not None:
+        return ray_directions(ctx.project(coords), ctx.frame, ctx.rotation)
     # get vectors which define view frustum of camera
-    top_left = camera.data.view_frame(scene=scene)[-1]
+    frame = np.array([tuple(v) for v in camera.data.view_frame(scene=scene)], dtype=np.float64)
+    rot = np.array(camera.matrix_world.to_quaternion().to_matrix(), dtype=np.float64)
+    return ray_directions(world_to_camera_view_np(scene, camera, coords), frame, rot)
+
 
+# camera_ray_directions of the world_to_camera_view_np coordinates co, frame corners and camera rotation rot
+def ray_directions(co, frame, rot):
     # convert [0, 1] to [-.5, .5]
-    x, y, _ = world_to_camera_view(scene, camera, boneVec)
-    pix_vec = Vector((x-.5, y-.5, top_left[2]))
-    pix_vec.rotate(camera.matrix_world.to_quaternion())
+    pix_vec = np.empty_like(co)
+    pix_vec[:, 0] = co[:, 0] - .5
+    pix_vec[:, 1] = co[:, 1] - .5
+    # depth of the top left corner
+    pix_vec[:, 2] = frame[-1, 2]
+    return pix_vec @ rot.T
+
+
+# function to check the occlusion of many world space points at once
+# camera, depsgraph and ray directions are computed a single time for all points
+# the bvh backend builds the tree once if it is not given
+# ctx: FrameContext, its depsgraph, camera and bvh tree are used, camera is ignored
+# return boolean array, True if the point is occluded
+def is_occluded_batch(camera, coords, threshold=.2, backend='scene_raycast', tree=None, ctx=None):
+    if backend not in occlusion_backends:
+        raise ValueError("unknown occlusion backend: {}, expected one of {}".format(backend, occlusion_backends))
+    scene = bpy.context.scene if ctx is None else ctx.scene
+    dg = bpy.context.evaluated_depsgraph_get() if ctx is None else ctx.dg
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    thresholds = np.broadcast_to(np.asarray(threshold, dtype=np.float64), (len(coords),))
+    directions = -camera_ray_directions(scene, camera, coords, ctx)
+    if backend == 'bvh' and tree is None and len(coords) > 0:
+        tree = build_bvh_tree(dg) if ctx is None else ctx.bvh_tree()
+
+    occluded = np.zeros(len(coords), dtype=bool)
+    for i in range(len(coords)):
+        # direction_hit equal to visible check
+        if backend == 'bvh':
+            occluded[i] = not direction_hit_bvh(tree, Vector(coords[i]), Vector(directions[i]), dist=float(thresholds[i]))
+        else:
+            occluded[i] = not direction_hit(scene, Vector(coords[i]), Vector(directions[i]), dist=float(thresholds[i]), dg=dg)
+    return occluded
+
+
+# function to build one bvh tree in world space of every visible evaluated mesh in the scene
+def build_bvh_tree(dg=None):
+    if dg is None: dg = bpy.context.evaluated_depsgraph_get()
+    verts, tris = [], []
+    offset = 0
+    for obj in bpy.context.scene.objects:
+        if obj.type != 'MESH' or not obj.visible_get(): continue
+        eval_object = obj.evaluated_get(dg)
+        mesh = eval_object.to_mesh()
+        mesh.calc_loop_triangles()
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        tri = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get('vertices', tri)
+        eval_object.to_mesh_clear()
+
+        matrix = np.array(eval_object.matrix_world, dtype=np.float64)
+        verts.append(co.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3])
+        tris.append(tri.reshape(-1, 3) + offset)
+        offset += len(co) // 3
+
+    if offset == 0: return BVHTree.FromPolygons([], [])
+    return BVHTree.FromPolygons(np.concatenate(verts).tolist(), np.concatenate(tris).tolist(), epsilon=0.0)
+
+
+# same as direction_hit, but cast against a bvh tree instead of the scene
+def direction_hit_bvh(tree, loc, direction, dist=1):
+    e = 1e-6
 
-    # direction_hit equal to visible check
-    return not direction_hit(scene, boneVec, -pix_vec, dist=threshold)
+    hit_loc, _, _, _ = tree.ray_cast(loc, direction, dist)
+    counters['ray_cast'] += 1
+    # does not hit anything, be occluded by other bones
+    if hit_loc is None: return False
 
+    while(hit_loc is not None):
+        hit_loc, normal, _, _ = tree.ray_cast(hit_loc + e * direction, direction)
+        counters['ray_cast'] += 1
+        # hit normal direction is opposite to ray direction
+        if hit_loc is not None and normal.dot(direction) < 0: return False
 
-def direction_hit(scene, loc, direction, dist=1):
-    init_status = False
-    dg = bpy.context.evaluated_depsgraph_get()
+    return True
+
+
+def direction_hit(scene, loc, direction, dist=1, dg=None, ctx=None):
+    if dg is None: dg = bpy.context.evaluated_depsgraph_get() if ctx is None else ctx.dg
     e = 1e-6
 
     is_hit, loc, _, _, _, _ = scene.ray_cast(
         dg, loc, direction, distance=dist
     )
+    counters['ray_cast'] += 1
     # does not hit anything, be occluded by other bones
     if not is_hit: return False
 
@@ -557,12 +1084,97 @@ def direction_hit(scene, loc, direction, dist=1):
         is_hit, loc, normal, _, _, _ = scene.ray_cast(
             dg, loc, direction
         )
+        counters['ray_cast'] += 1
         # hit normal direction is opposite to ray direction
         if normal.dot(direction) < 0: return False
 
     return True
 
 
+# pose generation and current FrameContext of frame_context
+# every function of base_ops that changes the pose, the placement or the visibility of the armatures increases the generation
+frame_state = {'generation': 0, 'context': None}
+
+
+# function to mark the cached pose state as stale, call it after changing the pose outside of base_ops, e.g. PoseBank.apply
+def invalidate_frame_context():
+    frame_state['generation'] += 1
+
+
+# function to get the key of everything the camera projection depends on
+def camera_key(scene, camera):
+    data, render = camera.data, scene.render
+    return (
+        camera.name, tuple(tuple(row) for row in camera.matrix_world), data.type, data.lens, data.ortho_scale,
+        data.sensor_fit, data.sensor_width, data.sensor_height, data.shift_x, data.shift_y,
+        render.resolution_x, render.resolution_y, render.pixel_aspect_x, render.pixel_aspect_y,
+    )
+
+
+# evaluated scene state of one frame, shared by the annotators
+# the depsgraph and the visible armatures and their meshes are read when the context is made
+# mesh coordinates, bone positions and the bvh tree are read on first use and kept for every camera of the frame
+# the camera matrices and frustum are read again by set_camera
+class FrameContext():
+    def __init__(self, scene=None, camera=None):
+        self.scene = scene if scene is not None else bpy.context.scene
+        self.frame_current = self.scene.frame_current
+        self.generation = frame_state['generation']
+        self.dg = bpy.context.evaluated_depsgraph_get()
+        self.armatures = list_armatures(visible_only=True)
+        # visible child meshes of every visible armature
+        self.meshes = {arma.name: [child for child in arma.children if child.visible_get()] for arma in self.armatures}
+        self.coords = {}
+        self.heads = {}
+        self.tree = None
+        self.set_camera(camera if camera is not None else self.scene.camera)
+
+    def set_camera(self, camera):
+        self.camera = camera
+        self.camera_key = camera_key(self.scene, camera)
+        # world to camera matrix, frame corners of the frustum and camera rotation
+        self.matrix, self.frame, self.ortho = camera_projection(self.scene, camera)
+        self.rotation = np.array(camera.matrix_world.to_quaternion().to_matrix(), dtype=np.float64)
+
+    # True while the frame and the pose are the ones the context was made for
+    def is_current(self, scene):
+        return scene == self.scene and scene.frame_current == self.frame_current and frame_state['generation'] == self.generation
+
+    # world_to_camera_view_np with the camera of the context
+    def project(self, coords):
+        return project_view(coords, self.matrix, self.frame, self.ortho)
+
+    # world space coordinates of the evaluated mesh of an object
+    def mesh_coords(self, obj_name):
+        if obj_name not in self.coords: self.coords[obj_name] = get_mesh_coords_world(obj_name, self.dg)
+        return self.coords[obj_name]
+
+    # get_bones_world of an armature
+    def bones_world(self, arma, bone_names):
+        if arma.name not in self.heads: self.heads[arma.name] = get_heads_world(arma)
+        return select_bones(*self.heads[arma.name], bone_names)
+
+    # bvh tree of every visible mesh of the frame
+    def bvh_tree(self):
+        if self.tree is None: self.tree = build_bvh_tree(self.dg)
+        return self.tree
+
+
+# function to get the FrameContext of the current frame, pose and camera
+# a new context is made when the frame or the pose generation changed, the camera is read again when it moved
+def frame_context(camera=None):
+    scene = bpy.context.scene
+    if camera is None: camera = scene.camera
+    # evaluate the pending changes, so matrix_world of the camera is up to date
+    bpy.context.evaluated_depsgraph_get()
+    ctx = frame_state['context']
+    if ctx is None or not ctx.is_current(scene):
+        ctx = frame_state['context'] = FrameContext(scene, camera)
+    elif ctx.camera_key != camera_key(scene, camera):
+        ctx.set_camera(camera)
+    return ctx
+
+
 def easy_mask_mode():
     """
     a simple function to set settings for mask rendering
@@ -591,8 +1203,243 @@ def easy_mask_mode():
 
 
 
-def single_render(layer_name):
-    bpy.context.scene.render.use_single_layer = False
-    bpy.context.scene.view_layers[layer_name].use = False
-    bpy.ops.render.render()
+def easy_color_mode():
+    """
+    a simple function to set settings for color rendering
+    """
+    # open depth of field
+    bpy.context.scene.camera.data.dof.use_dof = True
+    bpy.context.scene.render.film_transparent = False
+
+    # for eevee render engine
+    bpy.context.scene.eevee.taa_render_samples = 128
+    bpy.context.scene.eevee.use_taa_reprojection = True
+    bpy.context.scene.eevee.use_motion_blur = True
+
+    # bake settings to ADJACENT_FACES
+    bpy.context.scene.render.bake.margin_type = 'ADJACENT_FACES'
+
+
+# function to set the body part switch of the geometry nodes of every armature mesh
+# value 1 shows body part colors, 0 shows textures
+def set_body_part_mode(armas, value):
+    for obj in armas:
+        for child in bpy.data.objects[obj.name].children:
+            if child.type == "MESH":
+                child.modifiers["GeometryNodes"]["Input_2"] = value
+
+
+# file extensions of the image formats of the compositor file output nodes
+image_extensions = {'PNG': '.png', 'JPEG': '.jpg', 'OPEN_EXR': '.exr', 'OPEN_EXR_MULTILAYER': '.exr', 'TIFF': '.tif', 'BMP': '.bmp', 'WEBP': '.webp'}
+
+
+# function to list the file names a compositor file output node writes for the given frame
+def output_file_names(node, frame=None):
+    if frame is None: frame = bpy.context.scene.frame_current
+    names = []
+    for slot in node.file_slots:
+        file_format = (node.format if slot.use_node_format else slot.format).file_format
+        names.append("{}{:04d}{}".format(slot.path, frame, image_extensions.get(file_format, '.' + file_format.lower())))
+    return names
+
+
+# function to make a compositor file output node write uncompressed float exr, the fastest format to write
+# the raw files are encoded by image_writer outside of the render, return the color channels of every slot before
+def set_raw_exr_output(node):
+    channels = []
+    for slot in node.file_slots:
+        image_format = node.format if slot.use_node_format else slot.format
+        channels.append(4 if image_format.color_mode == 'RGBA' else 3)
+        slot.use_node_format = True
+    node.format.file_format = 'OPEN_EXR'
+    node.format.exr_codec = 'NONE'
+    node.format.color_depth = '32'
+    node.format.color_mode = 'RGBA'
+    return channels
+
+
+# counters of the work done by base_ops, render is increased by blender after every finished render
+# ray_cast by every ray cast of the occlusion check
+counters = {'render': 0, 'ray_cast': 0}
+
+
+def count_render(scene, *args):
+    counters['render'] += 1
+
+
+# register the render counter once, also when base_ops is reloaded
+for handler in list(bpy.app.handlers.render_post):
+    if getattr(handler, '__name__', None) == 'count_render':
+        bpy.app.handlers.render_post.remove(handler)
+bpy.app.handlers.render_post.append(count_render)
+
+
+# function to render only the given view layer, with one render call
+# outputs: names of the compositor file output nodes to write, the others are muted during this render
+#          all file output nodes are written if outputs is None
+def single_render(layer_name, outputs=None):
+    scene = bpy.context.scene
+    # only the given view layer is rendered, background mode ignores the layer argument of render
+    layer_use = {layer.name: layer.use for layer in scene.view_layers}
+    for layer in scene.view_layers:
+        layer.use = layer.name == layer_name
+    node_mute = {}
+    if outputs is not None and scene.node_tree is not None:
+        for node in scene.node_tree.nodes:
+            if node.type == 'OUTPUT_FILE':
+                node_mute[node.name] = node.mute
+                node.mute = node.name not in outputs
+
+    scene.render.use_single_layer = False
     bpy.ops.render.render(layer=layer_name)
+
+    # restore the view layers and output nodes
+    for layer in scene.view_layers:
+        layer.use = layer_use[layer.name]
+    for name, mute in node_mute.items():
+        scene.node_tree.nodes[name].mute = mute
+
+
+# render pass scheduler, every scheduled view layer is rendered exactly once
+class RenderScheduler():
+    def __init__(self):
+        self.passes = []
+        # renders of the last run, counted by blender
+        self.render_count = 0
+
+    # schedule a view layer, setup is called right before its render
+    def add(self, layer_name, outputs=None, setup=None):
+        if layer_name in [name for name, _, _ in self.passes]:
+            raise ValueError("view layer {} is already scheduled".format(layer_name))
+        self.passes.append((layer_name, outputs, setup))
+
+    # render every scheduled view layer, return the number of renders
+    def run(self):
+        passes, self.passes = self.passes, []
+        start = counters['render']
+        for layer_name, outputs, setup in passes:
+            if setup is not None: setup()
+            single_render(layer_name, outputs)
+        self.render_count = counters['render'] - start
+        # regression check, one render per view layer
+        if self.render_count > len(passes):
+            raise RuntimeError("{} renders for {} view layers".format(self.render_count, len(passes)))
+        return self.render_count
+
+
+# shader aov names of the single pass render
+bodypart_aov = 'bodypart'
+instance_aov = 'instance'
+
+
+# function to find the body part texture of a material, the *_bodypix.png next to its *_dif texture
+def find_bodypix_texture(material, texture_dir):
+    for node in material.node_tree.nodes:
+        if node.type != 'TEX_IMAGE' or node.image is None: continue
+        name = os.path.splitext(os.path.basename(node.image.filepath))[0]
+        if '_dif' not in name: continue
+        character = name.split('_dif')[0]
+        for path in [
+            os.path.join(os.path.dirname(bpy.path.abspath(node.image.filepath)), character + '_bodypix.png'),
+            os.path.join(texture_dir, character, character + '_bodypix.png'),
+        ]:
+            if os.path.exists(path): return path
+    return None
+
+
+# function to add the body part and instance aov outputs to the materials of every armature mesh
+# body part color comes from the bodypix texture, instance id from the object pass index
+# a mesh without a bodypix texture is black in the body part output, it is printed
+def setup_aov_materials(texture_dir):
+    for idx, arma in enumerate(list_armatures(visible_only=False)):
+        for child in arma.children:
+            if child.type != 'MESH': continue
+            # instance id of the mask, 0 is the background
+            child.pass_index = idx + 1
+            new_materials, has_bodypix = 0, False
+            for slot in child.material_slots:
+                material = slot.material
+                if material is None or not material.use_nodes: continue
+                nodes, links = material.node_tree.nodes, material.node_tree.links
+                # every material gets the instance aov, skip the materials set up by an earlier call
+                if 'AOV ' + instance_aov in nodes: continue
+                new_materials += 1
+
+                bodypix = find_bodypix_texture(material, texture_dir)
+                if bodypix is not None:
+                    has_bodypix = True
+                    tex = nodes.new('ShaderNodeTexImage')
+                    tex.name = 'Bodypix Texture'
+                    tex.image = bpy.data.images.load(bodypix, check_existing=True)
+                    # body part colors are labels, do not interpolate them
+                    tex.interpolation = 'Closest'
+                    # decode the srgb label colors, the Standard view transform of the body part output encodes them back
+                    tex.image.colorspace_settings.name = 'sRGB'
+                    aov = nodes.new('ShaderNodeOutputAOV')
+                    aov.name = 'AOV ' + bodypart_aov
+                    aov.aov_name = bodypart_aov
+                    links.new(tex.outputs['Color'], aov.inputs['Color'])
+
+                info = nodes.new('ShaderNodeObjectInfo')
+                # id / 255, the mask output is written with the Raw view transform so 8 bit png keeps id as gray value
+                div = nodes.new('ShaderNodeMath')
+                div.operation = 'DIVIDE'
+                div.inputs[1].default_value = 255.0
+                aov = nodes.new('ShaderNodeOutputAOV')
+                aov.name = 'AOV ' + instance_aov
+                aov.aov_name = instance_aov
+                links.new(info.outputs['Object Index'], div.inputs[0])
+                links.new(div.outputs[0], aov.inputs['Value'])
+            if new_materials and not has_bodypix:
+                print("no bodypix texture for the materials of {} ({}), its body part output is black, add <character>_bodypix.png"
+                      " next to its _dif texture or in {}".format(child.name, arma.name, os.path.join(texture_dir, "<character>")))
+
+
+# function to route image, body part, mask and depth of one view layer to the compositor outputs
+# "Image Output" slot 0 is the image, "File Output" slots 0, 1, 2 are body part, mask and depth
+def setup_single_pass_compositor(layer_name='ViewLayer'):
+    scene = bpy.context.scene
+    view_layer = scene.view_layers[layer_name]
+    view_layer.use_pass_z = True
+    for name, aov_type in [(bodypart_aov, 'COLOR'), (instance_aov, 'VALUE')]:
+        if name not in [aov.name for aov in view_layer.aovs]:
+            aov = view_layer.aovs.add()
+            aov.name = name
+            aov.type = aov_type
+
+    nodes, links = scene.node_tree.nodes, scene.node_tree.links
+    render_layer = next((node for node in nodes if node.type == 'R_LAYERS' and node.layer == layer_name), None)
+    if render_layer is None:
+        render_layer = nodes.new('CompositorNodeRLayers')
+        render_layer.layer = layer_name
+    if 'Depth Normalize' in nodes:
+        normalize = nodes['Depth Normalize']
+    else:
+        normalize = nodes.new('CompositorNodeNormalize')
+        normalize.name = 'Depth Normalize'
+
+    links.new(render_layer.outputs['Image'], nodes["Image Output"].inputs[0])
+    links.new(render_layer.outputs[bodypart_aov], nodes["File Output"].inputs[0])
+    links.new(render_layer.outputs[instance_aov], nodes["File Output"].inputs[1])
+    links.new(render_layer.outputs['Depth'], normalize.inputs[0])
+    links.new(normalize.outputs[0], nodes["File Output"].inputs[2])
+
+    # body part colors and instance ids are labels, write them with a fixed view transform instead of the one of the scene
+    output = nodes["File Output"]
+    for slot, view_transform in [(output.file_slots[0], 'Standard'), (output.file_slots[1], 'Raw')]:
+        if slot.use_node_format:
+            slot.use_node_format = False
+            slot.format.file_format = output.format.file_format
+            slot.format.color_mode = output.format.color_mode
+            slot.format.color_depth = output.format.color_depth
+        slot.format.color_management = 'OVERRIDE'
+        slot.format.view_settings.view_transform = view_transform
+        slot.format.view_settings.look = 'None'
+        slot.format.view_settings.exposure = 0.0
+        slot.format.view_settings.gamma = 1.0
+
+
+# function to set up the single pass render, image, body part, mask and depth from one render
+def setup_single_pass(texture_dir, layer_name='ViewLayer'):
+    setup_aov_materials(texture_dir)
+    setup_single_pass_compositor(layer_name)
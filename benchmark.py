@@ -0,0 +1,330 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import random
+import argparse
+
+import bpy
+import numpy as np
+from mathutils import Vector
+
+dir = os.path.dirname(os.path.abspath(__file__))
+if not dir in sys.path:
+    sys.path.append(dir)
+
+import importlib
+import base_ops
+importlib.reload(base_ops)
+import pose_bank
+importlib.reload(pose_bank)
+from base_ops import *
+from pose_bank import *
+
+
+# function to import a character fbx, return its armature and mesh objects
+def import_character(filepath):
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.ops.import_scene.fbx(
+        filepath=filepath,
+        axis_forward='Y',
+        axis_up='Z',
+        use_manual_orientation=True,
+        use_image_search=False,
+        use_anim=False,
+        ignore_leaf_bones=True,
+        automatic_bone_orientation=False,
+    )
+    objs = list(bpy.context.selected_objects)
+    armature = next((obj for obj in objs if obj.type == 'ARMATURE'), None)
+    meshes = [obj for obj in objs if obj.type == 'MESH']
+    return armature, meshes, objs
+
+
+# function to delete the given objects and their orphan data
+def remove_objects(objs):
+    for obj in objs:
+        bpy.data.objects.remove(obj, do_unlink=True)
+    bpy.ops.outliner.orphans_purge(do_recursive=True)
+
+
+# function to get the scene camera, create one if the scene has none
+def get_camera():
+    scene = bpy.context.scene
+    if scene.camera is None:
+        cam_data = bpy.data.cameras.new('Camera')
+        camera = bpy.data.objects.new('Camera', cam_data)
+        scene.collection.objects.link(camera)
+        scene.camera = camera
+    return scene.camera
+
+
+# function to place the camera in front of the given world space coordinates
+def frame_coords(camera, coords, distance=2.5):
+    center = Vector(((coords.min(axis=0) + coords.max(axis=0)) / 2).tolist())
+    camera.location = center + Vector((0, -distance, 0))
+    look_at(camera.name, center)
+    bpy.context.view_layer.update()
+
+
+# function to time a function, return the mean time of every call in seconds
+def time_it(func, repeat=5):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+# function to time every call of a function, return the timing statistics in seconds
+def time_stats(func, repeat=5, warmup=True):
+    if warmup: func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        "repeat": repeat,
+        "mean": float(times.mean()),
+        "min": float(times.min()),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+    }
+
+
+def bench_bbox(human_dir, repeat=5):
+    camera = get_camera()
+    results = []
+    print("{:<12} {:>8} {:>12} {:>12} {:>8} {:>10}".format("character", "verts", "loop (ms)", "numpy (ms)", "speedup", "max diff"))
+    for filepath in sorted(glob.glob(os.path.join(human_dir, "*.fbx"))):
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        _, meshes, objs = import_character(filepath)
+        for mesh in meshes:
+            frame_coords(camera, get_mesh_coords_world(mesh.name))
+            t_loop, bbox_loop = time_it(lambda: get_bounding_box_2d_legacy(mesh.name, camera), repeat)
+            t_np, bbox_np = time_it(lambda: get_bounding_box_2d(mesh.name, camera), repeat)
+            if bbox_loop is None or bbox_np is None:
+                diff = 0.0 if bbox_loop == bbox_np else float('inf')
+            else:
+                diff = max(abs(a - b) for a, b in zip(bbox_loop, bbox_np))
+            result = {
+                "character": name,
+                "mesh": mesh.name,
+                "verts": len(mesh.data.vertices),
+                "loop": t_loop,
+                "numpy": t_np,
+                "max_diff": diff,
+            }
+            results.append(result)
+            print("{:<12} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x {:>10.2e}".format(
+                name, result["verts"], t_loop * 1000, t_np * 1000, t_loop / t_np, diff))
+        remove_objects(objs)
+    return results
+
+
+# function to pose the armature with the given action at the given frame
+def pose_armature(armature, action, frame):
+    if armature.animation_data is None:
+        armature.animation_data_create()
+    armature.animation_data.action = action
+    bpy.context.scene.frame_set(int(frame))
+
+
+# parity and timing of the occlusion backends on every clip in anim/
+def bench_occlusion(human_dir, anim_dir, repeat=5, frames=3):
+    camera = get_camera()
+    anims = [bpy.data.actions[name] for name in load_animations(anim_dir)]
+    results = []
+    print("{:<12} {:<12} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+        "character", "clip", "frame", "points", "scene (ms)", "bvh (ms)", "mismatch"))
+    for filepath in sorted(glob.glob(os.path.join(human_dir, "*.fbx"))):
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        armature, meshes, objs = import_character(filepath)
+        for action in anims:
+            start, end = action.frame_range
+            for frame in np.linspace(start, end, frames).round():
+                pose_armature(armature, action, frame)
+                frame_coords(camera, get_mesh_coords_world(meshes[0].name))
+                coords = get_bones_world(armature, body_bones + hand_bones)
+                thresholds = np.concatenate([body_thresholds, hand_thresholds])
+                found = ~np.isnan(coords).any(axis=1)
+                coords, thresholds = coords[found], thresholds[found]
+
+                t_scene, occ_scene = time_it(lambda: is_occluded_batch(camera, coords, thresholds, backend='scene_raycast'), repeat)
+                # the bvh timing includes building the tree, once per frame
+                t_bvh, occ_bvh = time_it(lambda: is_occluded_batch(camera, coords, thresholds, backend='bvh'), repeat)
+                mismatch = int((occ_scene != occ_bvh).sum())
+                result = {
+                    "character": name,
+                    "clip": action.name,
+                    "frame": int(frame),
+                    "points": len(coords),
+                    "scene_raycast": t_scene,
+                    "bvh": t_bvh,
+                    "mismatch": mismatch,
+                }
+                results.append(result)
+                print("{:<12} {:<12} {:>6} {:>10} {:>10.3f} {:>10.3f} {:>10}".format(
+                    name, action.name[-12:], int(frame), len(coords), t_scene * 1000, t_bvh * 1000, mismatch))
+        remove_objects(objs)
+
+    total = sum(r["points"] for r in results)
+    mismatch = sum(r["mismatch"] for r in results)
+    print("parity: {} / {} keypoints differ between scene_raycast and bvh".format(mismatch, total))
+    return results
+
+
+# memory footprint of the pose bank and its sampling rate against apply_animation and set_frame
+def bench_pose_bank(human_dir, anim_dir, repeat=20):
+    anims = load_animations(anim_dir)
+    start = time.perf_counter()
+    bank = PoseBank.from_actions([bpy.data.actions[name] for name in anims])
+    bake_time = time.perf_counter() - start
+    print("pose bank: {} poses, {} bones, {:.1f} KiB ({:.1f} KiB per pose), bake time: {:.3f}s".format(
+        len(bank), len(bank.bone_names), bank.nbytes / 1024, bank.nbytes / 1024 / max(len(bank), 1), bake_time))
+
+    filepath = sorted(glob.glob(os.path.join(human_dir, "*.fbx")))[0]
+    armature, meshes, objs = import_character(filepath)
+
+    def sample_bank():
+        bank.apply(armature, bank.sample())
+        bpy.context.view_layer.update()
+
+    def sample_action():
+        apply_animation(random.choice(anims), armature.name)
+        set_frame(armature.animation_data.action.name, armature.name)
+
+    t_bank, _ = time_it(sample_bank, repeat)
+    t_action, _ = time_it(sample_action, repeat)
+    remove_objects(objs)
+    print("apply_animation + set_frame: {:.3f} ms, {:.1f} poses/s".format(t_action * 1000, 1 / t_action))
+    print("pose bank: {:.3f} ms, {:.1f} poses/s, {:.1f}x".format(t_bank * 1000, 1 / t_bank, t_action / t_bank))
+    return {
+        "poses": len(bank),
+        "bones": len(bank.bone_names),
+        "nbytes": bank.nbytes,
+        "bake": bake_time,
+        "bank": t_bank,
+        "action": t_action,
+    }
+
+
+# timing of the annotation and scene setup hot paths of base_ops, keyed by function and character
+def bench_suite(human_dir, anim_dir, hdr_dir, repeat=5):
+    results = {}
+
+    def record(name, stats):
+        results[name] = stats
+        print("{:<40} p50 {:>10.3f} ms  p95 {:>10.3f} ms".format(name, stats["p50"] * 1000, stats["p95"] * 1000))
+
+    # scene setup, every load imports the files again
+    record("load_hdrs", time_stats(lambda: load_hdrs(hdr_dir), repeat))
+    record("load_animations", time_stats(lambda: load_animations(anim_dir), 1, warmup=False))
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # the first call fills the cache, the timed calls link the cached libraries
+        record("load_animations_cached", time_stats(lambda: load_animations(anim_dir, cache_dir), repeat))
+    finally:
+        shutil.rmtree(cache_dir)
+    anims = list_animations()
+
+    camera = get_camera()
+    for filepath in sorted(glob.glob(os.path.join(human_dir, "*.fbx"))):
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        armature, meshes, objs = import_character(filepath)
+        mesh = max(meshes, key=lambda obj: len(obj.data.vertices))
+
+        # apply_animation bakes the action into the pose, keep the last baked pose for the annotation timings
+        record("apply_animation/" + name, time_stats(lambda: apply_animation(random.choice(anims), armature.name), repeat))
+        bpy.context.view_layer.update()
+        frame_coords(camera, get_mesh_coords_world(mesh.name))
+
+        record("get_bounding_box_2d/" + name, time_stats(lambda: get_bounding_box_2d(mesh.name, camera), repeat))
+        record("get_bounding_box_3d/" + name, time_stats(lambda: get_bounding_box_3d(mesh.name, camera), repeat))
+        record("get_pose_to_dict/" + name, time_stats(lambda: get_pose_to_dict(armature.name, camera), repeat))
+        record("get_hand_to_dict/" + name, time_stats(lambda: get_hand_to_dict(armature.name, camera), repeat))
+
+        # one is_occluded call per body bone, like the per keypoint check before the batch version
+        coords = get_bones_world(armature, body_bones)
+        coords = [Vector(co) for co in coords[~np.isnan(coords).any(axis=1)]]
+        record("is_occluded/" + name, time_stats(lambda: [is_occluded(camera, co) for co in coords], repeat))
+
+        # the same annotations through a frame context, the mesh and the bones are read once for every repeat
+        ctx = frame_context(camera)
+        record("get_bounding_box_2d_ctx/" + name, time_stats(lambda: get_bounding_box_2d(mesh.name, ctx=ctx), repeat))
+        record("get_keypoints_ctx/" + name, time_stats(lambda: get_keypoints_to_dict([armature], ctx=ctx), repeat))
+        remove_objects(objs)
+        invalidate_frame_context()
+    return results
+
+
+# function to compare the results with a baseline, both keyed by name, on the p50 time
+# return the names slower than tolerance times the baseline
+def compare(results, baseline, tolerance=1.2):
+    regressions = []
+    print("{:<40} {:>12} {:>12} {:>8}".format("name", "base (ms)", "now (ms)", "ratio"))
+    for name, stats in results.items():
+        if name not in baseline: continue
+        ratio = stats["p50"] / baseline[name]["p50"] if baseline[name]["p50"] > 0 else float('inf')
+        slower = ratio > tolerance
+        if slower: regressions.append(name)
+        print("{:<40} {:>12.3f} {:>12.3f} {:>7.2f}x{}".format(
+            name, baseline[name]["p50"] * 1000, stats["p50"] * 1000, ratio, "  slower" if slower else ""))
+    missing = [name for name in baseline if name not in results]
+    if missing: print("not in this run: {}".format(", ".join(missing)))
+    print("{} of {} timings slower than {:.2f}x the baseline".format(len(regressions), len(results), tolerance))
+    return regressions
+
+
+if __name__ == "__main__":
+    # blender passes the script arguments after "--"
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="benchmark base_ops hot paths, run with: blender -b --python benchmark.py -- bbox")
+    parser.add_argument("bench", choices=["bbox", "occlusion", "pose_bank", "suite"], help="benchmark to run")
+    parser.add_argument("--human_dir", default=os.path.join(dir, "human"))
+    parser.add_argument("--anim_dir", default=os.path.join(dir, "anim"))
+    parser.add_argument("--hdr_dir", default=os.path.join(dir, "hdrs"))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", default=None, help="results json of an earlier suite run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="allowed p50 time ratio to the baseline")
+    args = parser.parse_args(argv)
+
+    # fixed seed, every run picks the same animations
+    random.seed(0)
+    failed = False
+    if args.bench == "bbox":
+        results = bench_bbox(args.human_dir, args.repeat)
+    elif args.bench == "occlusion":
+        results = bench_occlusion(args.human_dir, args.anim_dir, args.repeat)
+        # exit with error if the backends disagree
+        failed = any(r["mismatch"] for r in results)
+    elif args.bench == "pose_bank":
+        results = bench_pose_bank(args.human_dir, args.anim_dir, args.repeat)
+    elif args.bench == "suite":
+        results = bench_suite(args.human_dir, args.anim_dir, args.hdr_dir, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "bench": args.bench,
+                "blender": bpy.app.version_string,
+                "threads": bpy.context.scene.render.threads,
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["bench"] != args.bench:
+            raise ValueError("baseline of {} can not be compared with {}".format(baseline["bench"], args.bench))
+        if not isinstance(results, dict):
+            raise ValueError("only the suite results are keyed by name, compare {} by hand".format(args.bench))
+        # exit with error on a speed regression
+        failed = bool(compare(results, baseline["results"], args.tolerance)) or failed
+    if failed: sys.exit(1)
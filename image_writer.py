@@ -0,0 +1,233 @@
+import os
+import time
+import zlib
+import queue
+import struct
+import threading
+
+import numpy as np
+
+# webp encoding is optional, it needs pillow
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# encoded formats of every kind of render output, color is an image, depth is the normalized depth
+# mask is the silhouette of the persons, or the instance id of every pixel with instance_ids, exr keeps the raw render output
+output_formats = {'color': ['png', 'webp'], 'mask': ['png'], 'depth': ['png', 'exr']}
+
+exr_magic = 20000630
+# numpy type of the exr pixel types uint, half and float
+exr_pixel_types = {0: np.dtype('<u4'), 1: np.dtype('<f2'), 2: np.dtype('<f4')}
+
+
+# function to read an uncompressed single part scanline exr into {channel name: (H, W) array}
+# this is the raw format blender writes with codec NONE, compressed or tiled files are not supported
+def read_exr(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version = struct.unpack_from("<ii", data, 0)
+    if magic != exr_magic:
+        raise ValueError("{} is not an exr file".format(path))
+    # tiled 0x200, deep 0x800 and multi part 0x1000 flags, long attribute names 0x400 are read like short ones
+    if version & 0x1A00:
+        raise ValueError("{} is tiled, deep or multi part, only single part scanline exr is supported".format(path))
+
+    # header attributes, name, type, size and value, until an empty name
+    pos, channels, compression, data_window = 8, [], None, None
+    while data[pos] != 0:
+        name_end = data.index(b"\0", pos)
+        type_end = data.index(b"\0", name_end + 1)
+        name = data[pos:name_end].decode()
+        size, = struct.unpack_from("<i", data, type_end + 1)
+        value = data[type_end + 5:type_end + 5 + size]
+        if name == "channels":
+            # name, pixel type, linear, reserved, x and y sampling, until an empty name
+            i = 0
+            while value[i] != 0:
+                channel_end = value.index(b"\0", i)
+                pixel_type, = struct.unpack_from("<i", value, channel_end + 1)
+                channels.append((value[i:channel_end].decode(), exr_pixel_types[pixel_type]))
+                i = channel_end + 17
+        elif name == "compression":
+            compression = value[0]
+        elif name == "dataWindow":
+            data_window = struct.unpack("<iiii", value)
+        pos = type_end + 5 + size
+    if compression != 0:
+        raise ValueError("{} is compressed, write the exr with codec NONE".format(path))
+
+    xmin, ymin, xmax, ymax = data_window
+    width, height = xmax - xmin + 1, ymax - ymin + 1
+    # one scanline per chunk, every chunk is y, size and the scanline of every channel in header order
+    offsets = np.frombuffer(data, dtype='<u8', count=height, offset=pos + 1).astype(np.int64)
+    line_size = sum(width * dtype.itemsize for _, dtype in channels)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    rows = np.array([struct.unpack_from("<i", data, offset)[0] for offset in offsets]) - ymin
+    lines = buffer[(offsets + 8)[:, None] + np.arange(line_size)]
+    lines = lines[np.argsort(rows)]
+
+    result, start = {}, 0
+    for name, dtype in channels:
+        end = start + width * dtype.itemsize
+        result[name] = np.ascontiguousarray(lines[:, start:end]).view(dtype).reshape(height, width)
+        start = end
+    return result
+
+
+# function to convert linear color to srgb, the standard view transform of blender
+def srgb_encode(linear):
+    linear = np.clip(linear, 0.0, 1.0)
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * np.power(linear, 1 / 2.4) - 0.055)
+
+
+# function to quantize [0, 1] values to unsigned integers of the given bit depth
+def quantize(values, bits=8):
+    scale = (1 << bits) - 1
+    return np.round(np.clip(values, 0.0, 1.0) * scale).astype(np.uint8 if bits == 8 else np.uint16)
+
+
+# function to convert premultiplied values, as blender writes them to exr, to the straight alpha of png
+def unpremultiply(values, alpha):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(alpha > 0, values / alpha, 0.0)
+
+
+# fixed palette of the instance masks, index 0 is the black background
+def mask_palette(size=256):
+    rng = np.random.RandomState(0)
+    palette = rng.randint(64, 256, size=(size, 3)).astype(np.uint8)
+    palette[0] = 0
+    return palette
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+# function to encode a (H, W) or (H, W, C) uint8 or uint16 array as png bytes
+# palette (N, 3) writes an indexed png of a (H, W) uint8 array
+def encode_png(array, level=6, palette=None):
+    array = np.asarray(array)
+    height, width = array.shape[:2]
+    channel = 1 if array.ndim == 2 else array.shape[2]
+    bit_depth = 16 if array.dtype == np.uint16 else 8
+    color_type = 3 if palette is not None else {1: 0, 2: 4, 3: 2, 4: 6}[channel]
+    # png stores 16 bit values big endian, every row starts with filter type 0
+    raw = array.astype('>u2' if bit_depth == 16 else np.uint8).reshape(height, -1).view(np.uint8)
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), raw])
+
+    chunks = [png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, color_type, 0, 0, 0))]
+    if palette is not None:
+        chunks.append(png_chunk(b"PLTE", np.asarray(palette, dtype=np.uint8).tobytes()))
+    chunks.append(png_chunk(b"IDAT", zlib.compress(rows.tobytes(), level)))
+    chunks.append(png_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+
+# function to convert one raw exr render output into its encoded file and remove the exr
+# kind: color, mask or depth, fmt: encoded format of the kind, see output_formats
+# channels: number of color channels of a color output, 3 is RGB, 4 is RGBA
+# srgb: apply the srgb transfer to a color output or a silhouette mask, False for the raw view transform
+# instance_ids: the mask stores instance id / 255, it is written as a palette png, else as a gray and alpha png
+def convert_output(exr_path, out_path, kind, fmt="png", level=6, channels=3, srgb=True, quality=90, instance_ids=False):
+    if fmt not in output_formats[kind]:
+        raise ValueError("{} output can not be written as {}".format(kind, fmt))
+    if fmt == "exr":
+        os.replace(exr_path, out_path)
+        return out_path
+
+    layers = read_exr(exr_path)
+    if kind == 'color':
+        names = ["R", "G", "B", "A"][:channels]
+        color = np.stack([layers[name].astype(np.float32) for name in names], axis=-1)
+        if channels == 4: color[..., :3] = unpremultiply(color[..., :3], color[..., 3:])
+        if srgb: color[..., :3] = srgb_encode(color[..., :3])
+        array = quantize(color, 8)
+    elif kind == 'mask' and not instance_ids:
+        # silhouette of the mask view layer, keep its anti-aliased edges and alpha like the png blender writes
+        gray = layers["R"].astype(np.float32)
+        alpha = layers["A"].astype(np.float32) if channels == 4 and "A" in layers else np.ones_like(gray)
+        gray = unpremultiply(gray, alpha)
+        if srgb: gray = srgb_encode(gray)
+        array = quantize(np.stack([gray, alpha], axis=-1), 8)
+    else:
+        value = layers["R"] if "R" in layers else next(iter(layers.values()))
+        # the instance id is stored as id / 255, the depth is normalized to [0, 1]
+        array = quantize(value.astype(np.float32), 8 if kind == 'mask' else 16)
+
+    tmp_path = out_path + ".tmp"
+    if fmt == "webp":
+        if Image is None:
+            raise ValueError("webp output needs pillow, install it with pip install pillow")
+        Image.fromarray(array).save(tmp_path, format="WEBP", quality=quality)
+    else:
+        with open(tmp_path, "wb") as f:
+            f.write(encode_png(array, level, mask_palette() if kind == 'mask' and instance_ids else None))
+    os.replace(tmp_path, out_path)
+    os.remove(exr_path)
+    return out_path
+
+
+# pool of writer threads, every job is a convert_output call
+# the queue holds at most max_queue jobs, submit blocks while it is full, stall_time is the time blocked in submit
+class WriterPool():
+    def __init__(self, workers=2, max_queue=8):
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        # outstanding jobs of every key
+        self.outstanding = {}
+        self.errors = []
+        self.stall_time = 0.0
+        self.written = 0
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads: thread.start()
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: break
+            key, kwargs = job
+            try:
+                convert_output(**kwargs)
+            except Exception as e:
+                self.errors.append((kwargs["exr_path"], e))
+            with self.lock:
+                self.outstanding[key] -= 1
+                if self.outstanding[key] == 0: del self.outstanding[key]
+                self.written += 1
+            self.jobs.task_done()
+
+    # raise the first error of a writer thread
+    def check(self):
+        if self.errors:
+            path, error = self.errors[0]
+            raise RuntimeError("writing {} failed: {}".format(path, error)) from error
+
+    # queue the conversion of one output, key groups the jobs of one sample
+    def submit(self, key, **kwargs):
+        self.check()
+        with self.lock:
+            self.outstanding[key] = self.outstanding.get(key, 0) + 1
+        start = time.perf_counter()
+        self.jobs.put((key, kwargs))
+        self.stall_time += time.perf_counter() - start
+
+    # True if every job of the key is written
+    def done(self, key):
+        with self.lock:
+            return key not in self.outstanding
+
+    # wait for every queued job
+    def join(self):
+        self.jobs.join()
+        self.check()
+
+    def close(self):
+        self.jobs.join()
+        for _ in self.threads: self.jobs.put(None)
+        for thread in self.threads: thread.join()
+        self.threads = []
+        self.check()
@@ -0,0 +1,36 @@
+# keypoint names shared by the blender scripts and the annotation tools
+
+pose_head = ['nose', 'ear_r', 'ear_l', 'eye_end_r', 'eye_end_l',]
+
+# pose part names
+pose_parts = {
+    'nose': 'Nose',
+    'Neck': 'Neck',
+    'RightArm': 'RightArm', 'RightForeArm': 'RightForeArm', 'RightHand': 'RightHand',
+    'LeftArm': 'LeftArm', 'LeftForeArm': 'LeftForeArm', 'LeftHand': 'LeftHand',
+    'RightUpLeg': 'RightUpLeg', 'RightLeg': 'RightLeg', 'RightFoot': 'RightFoot',
+    'LeftUpLeg': 'LeftUpLeg', 'LeftLeg': 'LeftLeg', 'LeftFoot': 'LeftFoot',
+    'eye_end_r': 'RightEye', 'eye_end_l': 'LeftEye',
+    'ear_r': 'RightEar', 'ear_l': 'LeftEar',
+}
+
+# hands part names
+hand_parts = [
+    'LeftHand',
+    'LeftHandThumb1', 'LeftHandThumb2', 'LeftHandThumb3', 'LeftHandThumb4',
+    'LeftHandIndex1', 'LeftHandIndex2', 'LeftHandIndex3', 'LeftHandIndex4',
+    'LeftHandMiddle1', 'LeftHandMiddle2', 'LeftHandMiddle3', 'LeftHandMiddle4',
+    'LeftHandRing1', 'LeftHandRing2', 'LeftHandRing3', 'LeftHandRing4',
+    'LeftHandPinky1', 'LeftHandPinky2', 'LeftHandPinky3', 'LeftHandPinky4',
+    'RightHand', 
+    'RightHandThumb1', 'RightHandThumb2', 'RightHandThumb3', 'RightHandThumb4',
+    'RightHandIndex1', 'RightHandIndex2', 'RightHandIndex3', 'RightHandIndex4',
+    'RightHandMiddle1', 'RightHandMiddle2', 'RightHandMiddle3', 'RightHandMiddle4',
+    'RightHandRing1', 'RightHandRing2', 'RightHandRing3', 'RightHandRing4',
+    'RightHandPinky1', 'RightHandPinky2', 'RightHandPinky3', 'RightHandPinky4',
+]
+
+# keypoint order of the array form, body follows pose_parts, hand follows hand_parts
+body_bones = list(pose_parts.keys())
+body_labels = [pose_parts[name] for name in body_bones]
+hand_bones = list(hand_parts)
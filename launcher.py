@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import glob
+import json
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+
+from manifest import manifest_name, read_done
+from timing import report_name, profile_name
+
+
+# output file prefixes written by synth.py for every sample
+sample_prefixes = ['img_', 'body_', 'mask_', 'depth_']
+
+
+# function to get the sample key of an output file, the file name without prefix and extension
+# return None if the file is not a sample output
+def sample_key(file_name):
+    name = os.path.splitext(file_name)[0]
+    for prefix in sample_prefixes:
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return None
+
+
+# function to list the finished samples in a directory
+# a sample is finished when it is done in the manifest of the directory
+# without manifest, a sample is finished when its xml exists or its record is in a jsonl shard
+def list_finished(directory):
+    if os.path.exists(os.path.join(directory, manifest_name)):
+        return set(sample_key(file_name) for record in read_done(directory) for file_name in record["files"])
+    finished = set(sample_key(os.path.basename(path)) for path in glob.glob(os.path.join(directory, "img_*.xml")))
+    for path in glob.glob(os.path.join(directory, "*.jsonl")):
+        # the merged manifests of the workers are not annotations
+        if path.endswith(manifest_name): continue
+        with open(path) as f:
+            for line in f:
+                # skip a partly written last line
+                try:
+                    finished.add(sample_key(json.loads(line)["image"]["file_name"]))
+                except ValueError:
+                    continue
+    array_shards = glob.glob(os.path.join(directory, "arrays", "*", "meta.json"))
+    if array_shards:
+        from array_store import read_names
+        for path in array_shards:
+            finished.update(sample_key(name) for name in read_names(os.path.dirname(path)))
+    return finished
+
+
+# function to list the merged samples of a seed in the dataset directory
+# the workers of a run with the same seed would generate the same sample names again
+def merged_samples(dataset_dir, seed):
+    if not os.path.isdir(dataset_dir): return set()
+    prefix = "s{}_w".format(seed)
+    keys = set(sample_key(file_name) for file_name in os.listdir(dataset_dir))
+    return set(key for key in keys if key is not None and key.startswith(prefix))
+
+
+class Worker():
+    def __init__(self, worker_id, blend_file, script, shard_dir, log_dir, seed, quota, blender="blender", threads=1, extra_args=[]):
+        self.worker_id = worker_id
+        self.blend_file = blend_file
+        self.script = script
+        self.shard_dir = shard_dir
+        self.log_path = os.path.join(log_dir, "worker_{:03d}.log".format(worker_id))
+        self.seed = seed
+        self.quota = quota
+        self.blender = blender
+        self.threads = threads
+        self.extra_args = extra_args
+        self.proc = None
+        self.log = None
+        self.restarts = 0
+        self.failed = False
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+    def done(self):
+        return len(list_finished(self.shard_dir))
+
+    def finished(self):
+        return self.failed or self.done() >= self.quota
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        # continue from the finished samples, synth.py skips the samples done in the manifest of the shard
+        # and counts them toward the quota
+        cmd = [
+            self.blender, "-b", self.blend_file,
+            "-t", str(self.threads),
+            "--python", self.script,
+            "--",
+            "--num", str(self.quota),
+            "--outpath", self.shard_dir,
+            "--seed", str(self.seed),
+            "--worker_id", str(self.worker_id),
+        ] + list(self.extra_args)
+        if self.log is not None: self.log.close()
+        self.log = open(self.log_path, "a")
+        self.proc = subprocess.Popen(cmd, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def stop(self):
+        if self.running():
+            self.proc.terminate()
+            self.proc.wait()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+# function to move a file or directory, never over an existing one
+# shutil.move would replace a file and nest a directory inside an existing one
+def move_new(src, dst):
+    if os.path.exists(dst):
+        raise FileExistsError("{} exists, not overwriting it with {}".format(dst, src))
+    shutil.move(src, dst)
+
+
+# function to move the finished samples of every shard into the dataset directory
+# unfinished samples are left in their shard, return the number of moved samples and left files
+# jsonl and array shards, manifests and timing reports of every worker are numbered per run
+# they are prefixed with run_name and the worker name, so the merges of several runs into one directory do not collide
+def merge_shards(shard_dirs, dataset_dir, run_name):
+    os.makedirs(dataset_dir, exist_ok=True)
+    merged, left = 0, 0
+    for shard_dir in shard_dirs:
+        finished = list_finished(shard_dir)
+        merged += len(finished)
+        prefix = "{}_{}_".format(run_name, os.path.basename(os.path.normpath(shard_dir)))
+        for file_name in os.listdir(shard_dir):
+            if sample_key(file_name) in finished:
+                move_new(os.path.join(shard_dir, file_name), os.path.join(dataset_dir, file_name))
+            elif file_name == "arrays":
+                # array shards are directories
+                os.makedirs(os.path.join(dataset_dir, "arrays"), exist_ok=True)
+                for array_shard in os.listdir(os.path.join(shard_dir, "arrays")):
+                    move_new(os.path.join(shard_dir, "arrays", array_shard), os.path.join(dataset_dir, "arrays", prefix + array_shard))
+                os.rmdir(os.path.join(shard_dir, "arrays"))
+            elif file_name == manifest_name:
+                # keep the manifest in the shard until every file is merged, a rerun skips its done samples
+                shutil.copy(os.path.join(shard_dir, file_name), os.path.join(dataset_dir, prefix + file_name))
+            elif file_name in [report_name, profile_name]:
+                # timing report and profile of the worker
+                move_new(os.path.join(shard_dir, file_name), os.path.join(dataset_dir, prefix + file_name))
+            elif file_name.endswith(".jsonl"):
+                move_new(os.path.join(shard_dir, file_name), os.path.join(dataset_dir, prefix + file_name))
+            else:
+                left += 1
+        # remove the shard if every file is merged
+        if os.listdir(shard_dir) == [manifest_name]: os.remove(os.path.join(shard_dir, manifest_name))
+        if not os.listdir(shard_dir): os.rmdir(shard_dir)
+    return merged, left
+
+
+def launch(blend_file, num, workers, outpath, seed=0, blender="blender", threads=1, interval=10, max_restarts=3, extra_args=[]):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synth.py")
+    # fail before rendering instead of in the merge, the merge never overwrites a sample
+    # samples done in the kept manifest of an unfinished shard are skipped by its worker and do not collide
+    resumable = set()
+    for shard_dir in glob.glob(os.path.join(outpath, "shards", "worker_*")):
+        resumable |= list_finished(shard_dir)
+    collisions = merged_samples(outpath, seed) - resumable
+    if collisions:
+        raise FileExistsError("{} already has {} merged samples of seed {}, use another --seed or --outpath".format(
+            outpath, len(collisions), seed))
+    shard_root = os.path.join(outpath, "shards")
+    log_dir = os.path.join(outpath, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    # prefix of the merged per worker files of this run
+    run_name = time.strftime("run_%Y%m%d_%H%M%S")
+
+    # split the samples into one quota per worker, the worker id keeps the sample seeds and names apart
+    pool = []
+    for i in range(workers):
+        quota = num // workers + (1 if i < num % workers else 0)
+        if quota == 0: continue
+        pool.append(Worker(
+            i, blend_file, script,
+            os.path.join(shard_root, "worker_{:03d}".format(i)), log_dir,
+            seed, quota, blender, threads, extra_args
+        ))
+
+    start = time.perf_counter()
+    for worker in pool:
+        if not worker.finished(): worker.start()
+
+    try:
+        while True:
+            for worker in pool:
+                if worker.running() or worker.finished(): continue
+                # the worker exited before its quota, restart it
+                if worker.restarts >= max_restarts:
+                    worker.failed = True
+                    print("worker {} failed after {} restarts, see {}".format(worker.worker_id, worker.restarts, worker.log_path))
+                    continue
+                worker.restarts += 1
+                print("worker {} exited with code {}, restart {}/{}".format(
+                    worker.worker_id, worker.proc.returncode, worker.restarts, max_restarts))
+                worker.start()
+
+            done = sum(min(worker.done(), worker.quota) for worker in pool)
+            use_time = time.perf_counter() - start
+            print("progress: {}/{} samples, {}/{} workers running, {:.3f} img/s".format(
+                done, num, sum(worker.running() for worker in pool), len(pool), done / use_time if use_time > 0 else 0))
+            if all(worker.finished() for worker in pool): break
+            time.sleep(interval)
+    finally:
+        for worker in pool: worker.stop()
+
+    merged, left = merge_shards([worker.shard_dir for worker in pool], outpath, run_name)
+    if os.path.isdir(shard_root) and not os.listdir(shard_root): os.rmdir(shard_root)
+    print("merged {} samples into {}, {} unfinished files left in {}".format(merged, outpath, left, shard_root))
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run many background blender workers of synth.py and merge their output")
+    parser.add_argument("blend_file", help="blend file to render")
+    parser.add_argument("--num", type=int, required=True, help="total number of samples")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--threads", type=int, default=1, help="render threads per worker")
+    parser.add_argument("--outpath", default="data")
+    parser.add_argument("--seed", type=int, default=0, help="global seed of the sample seeds of every worker")
+    parser.add_argument("--blender", default="blender", help="blender executable")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between progress reports")
+    parser.add_argument("--max_restarts", type=int, default=3, help="restarts of a crashed worker")
+    # arguments after "--" are passed to every synth.py worker
+    argv = sys.argv[1:]
+    extra_args = []
+    if "--" in argv:
+        extra_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+
+    merged = launch(
+        os.path.abspath(args.blend_file), args.num, args.workers, os.path.abspath(args.outpath),
+        args.seed, args.blender, args.threads, args.interval, args.max_restarts, extra_args
+    )
+    if merged < args.num: sys.exit(1)
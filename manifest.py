@@ -0,0 +1,115 @@
+import os
+import json
+import time
+
+
+# file name of the manifest in the output directory
+manifest_name = "manifest.jsonl"
+
+# status of a sample in the manifest, the last record of a sample is its status
+# started: written before the sample is generated, a started sample without a later record was interrupted
+# done: the output files and annotations of the sample are on disk
+# rejected: rejected by precheck, nothing was written
+# cleaned: the files of an interrupted sample were removed
+sample_status = ['started', 'done', 'rejected', 'cleaned']
+
+
+# function to read the last record of every sample id of a manifest file
+def read_manifest(path:str):
+    samples = {}
+    if not os.path.exists(path): return samples
+    with open(path) as f:
+        for line in f:
+            # skip a partly written last line
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            samples[record["id"]] = record
+    return samples
+
+
+# function to read the done records of the manifest in a directory, without opening it for writing
+def read_done(out_dir:str):
+    samples = read_manifest(os.path.join(out_dir, manifest_name))
+    return [record for record in samples.values() if record["status"] == 'done']
+
+
+# append-only manifest of the generated samples, one json record per line
+# a record is flushed to disk when it is written, so the manifest survives a crash
+class Manifest():
+    def __init__(self, out_dir:str):
+        self.path = os.path.join(out_dir, manifest_name)
+        # last record of every sample id
+        self.samples = read_manifest(self.path)
+        # (sample id, fields) of the done records that wait until the files of their samples are on disk
+        self.held = []
+        os.makedirs(out_dir, exist_ok=True)
+        self.file = open(self.path, "a")
+
+    def record(self, sample_id:str, status:str, **fields):
+        if status not in sample_status:
+            raise ValueError("unknown sample status: {}".format(status))
+        record = dict(id=sample_id, status=status, time=time.time(), **fields)
+        self.samples[sample_id] = record
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def status(self, sample_id:str):
+        record = self.samples.get(sample_id)
+        return None if record is None else record["status"]
+
+    # a finished sample is done or rejected, it is not generated again
+    def finished(self, sample_id:str):
+        return self.status(sample_id) in ['done', 'rejected']
+
+    # number of the sample ids done in an earlier run, they count toward the samples to generate
+    def done_count(self, sample_ids):
+        return sum(1 for sample_id in sample_ids if self.status(sample_id) == 'done')
+
+    # a sample name is skipped on resume if it was rejected or every view or frame of it is finished
+    def skip(self, name:str, sample_ids):
+        return self.finished(name) or all(self.finished(sample_id) for sample_id in sample_ids)
+
+    # hold the done record of a sample until commit
+    def hold(self, sample_id:str, **fields):
+        self.held.append((sample_id, fields))
+
+    # write the done records of the held samples, ready(sample id) is False for a sample whose files are not written yet
+    def commit(self, ready=None):
+        held = []
+        for sample_id, fields in self.held:
+            if ready is not None and not ready(sample_id):
+                held.append((sample_id, fields))
+                continue
+            self.record(sample_id, 'done', **fields)
+        self.held = held
+
+    # forget the held samples, they stay started and are cleaned on resume
+    def drop(self):
+        self.held = []
+
+    def done(self):
+        return [record for record in self.samples.values() if record["status"] == 'done']
+
+    # samples started but never finished, their files may be incomplete
+    def partial(self):
+        return [record for record in self.samples.values() if record["status"] == 'started']
+
+    # function to remove the files of the interrupted samples, they are generated again on resume
+    # return the number of cleaned samples
+    def clean_partial(self, out_dir:str):
+        partial = self.partial()
+        for record in partial:
+            for file_name in record.get("files", []):
+                path = os.path.join(out_dir, file_name)
+                if os.path.exists(path): os.remove(path)
+            self.record(record["id"], 'cleaned', index=record.get("index"), seed=record.get("seed"))
+        return len(partial)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
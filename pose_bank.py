@@ -0,0 +1,181 @@
+import os
+import random
+import hashlib
+
+import bpy
+import numpy as np
+from mathutils import Euler
+
+
+# local transform channels of a bone in the bank: location (3), rotation quaternion (4), scale (3)
+channels = {'location': slice(0, 3), 'rotation_quaternion': slice(3, 7), 'scale': slice(7, 10)}
+rest_pose = np.array([0, 0, 0, 1, 0, 0, 0, 1, 1, 1], dtype=np.float32)
+
+
+# function to get the bone name and channel of an fcurve data path, e.g. pose.bones["Neck"].location
+def parse_data_path(data_path):
+    if not data_path.startswith('pose.bones["'): return None, None
+    bone_name, _, prop = data_path[len('pose.bones["'):].rpartition('"].')
+    return bone_name, prop
+
+
+# function to bake an action into a (F, B, 10) array of local bone transforms, evaluated from its fcurves
+# frames start at frame_range[0] + 2 like set_frame
+def bake_action(action, bone_names, step=1):
+    start, end = action.frame_range
+    frames = np.arange(min(start + 2, end), end + 1, step)
+    poses = np.tile(rest_pose, (len(frames), len(bone_names), 1))
+    index = {name: i for i, name in enumerate(bone_names)}
+    euler = {}
+
+    for fcurve in action.fcurves:
+        bone_name, prop = parse_data_path(fcurve.data_path)
+        if bone_name not in index: continue
+        values = np.array([fcurve.evaluate(frame) for frame in frames], dtype=np.float32)
+        if prop in channels:
+            poses[:, index[bone_name], channels[prop].start + fcurve.array_index] = values
+        elif prop == 'rotation_euler':
+            euler.setdefault(bone_name, np.zeros((len(frames), 3), dtype=np.float32))[:, fcurve.array_index] = values
+
+    # bones keyed with euler rotation are stored as quaternion
+    for bone_name, rotations in euler.items():
+        poses[:, index[bone_name], 3:7] = [tuple(Euler(rot).to_quaternion()) for rot in rotations]
+    return poses, frames
+
+
+# function to hash the keyframes of an action, the keys and handles of every fcurve
+def action_hash(action):
+    digest = hashlib.sha1()
+    for fcurve in action.fcurves:
+        digest.update("{}[{}]".format(fcurve.data_path, fcurve.array_index).encode())
+        points = fcurve.keyframe_points
+        for prop in ['co', 'handle_left', 'handle_right']:
+            values = np.empty(len(points) * 2, dtype=np.float32)
+            points.foreach_get(prop, values)
+            digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+# function to get what a bank baked from the actions depends on
+# (name, frame start, frame end, keyframe hash) of every action
+def action_ranges(actions):
+    return [
+        (action.name, float(action.frame_range[0]), float(action.frame_range[1]), action_hash(action))
+        for action in actions
+    ]
+
+
+# bank of baked poses, sampling a pose writes the bank entry straight into pose.bones
+# without operators or frame changes
+class PoseBank():
+    def __init__(self, bone_names, poses, sources, actions=None, step=1):
+        self.bone_names = list(bone_names)
+        # (P, B, 10) local transforms of every pose
+        self.poses = np.asarray(poses, dtype=np.float32)
+        # (action name, frame) of every pose
+        self.sources = list(sources)
+        # action_ranges of the baked actions, with their keyframe hash, and the frame step, None if unknown
+        self.actions = actions
+        self.step = step
+        # per armature index of the bank bones in pose.bones
+        self.bone_index = {}
+
+    @classmethod
+    def from_actions(cls, actions=None, step=1):
+        if actions is None: actions = list(bpy.data.actions)
+        bone_names = []
+        for action in actions:
+            for fcurve in action.fcurves:
+                bone_name, _ = parse_data_path(fcurve.data_path)
+                if bone_name is not None and bone_name not in bone_names: bone_names.append(bone_name)
+
+        poses, sources = [], []
+        for action in actions:
+            action_poses, frames = bake_action(action, bone_names, step)
+            poses.append(action_poses)
+            sources += [(action.name, int(frame)) for frame in frames]
+        poses = np.concatenate(poses) if poses else np.empty((0, len(bone_names), 10), dtype=np.float32)
+        return cls(bone_names, poses, sources, action_ranges(actions), step)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        sources = list(zip(data['source_actions'].tolist(), data['source_frames'].tolist()))
+        # banks saved before the action keys were stored are treated as stale
+        actions, step = None, 1
+        if 'action_hashes' in data:
+            actions = [
+                (name, float(start), float(end), digest) for name, (start, end), digest
+                in zip(data['action_names'].tolist(), data['action_ranges'].tolist(), data['action_hashes'].tolist())
+            ]
+            step = int(data['step'])
+        return cls(data['bone_names'].tolist(), data['poses'], sources, actions, step)
+
+    # True if the bank was baked from these actions with this step
+    def matches(self, actions, step=1):
+        return self.actions == action_ranges(actions) and self.step == step
+
+    def save(self, path):
+        # write through a file object, np.savez would append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                bone_names=np.array(self.bone_names),
+                poses=self.poses,
+                source_actions=np.array([name for name, _ in self.sources]),
+                source_frames=np.array([frame for _, frame in self.sources], dtype=np.int32),
+                action_names=np.array([name for name, _, _, _ in self.actions or []], dtype=str),
+                action_ranges=np.array([(start, end) for _, start, end, _ in self.actions or []], dtype=np.float64).reshape(-1, 2),
+                action_hashes=np.array([digest for _, _, _, digest in self.actions or []], dtype=str),
+                step=np.int32(self.step),
+            )
+
+    def __len__(self):
+        return len(self.poses)
+
+    @property
+    def nbytes(self):
+        return self.poses.nbytes
+
+    def sample(self, rng=random):
+        return rng.randrange(len(self.poses))
+
+    # function to write pose index of the bank into the pose bones of the armature
+    # call bpy.context.view_layer.update() before reading bone matrices
+    def apply(self, armature, index):
+        # an assigned action would override the written pose on the next evaluation
+        if armature.animation_data is not None: armature.animation_data.action = None
+        bones = armature.pose.bones
+        key = (armature.name, len(bones))
+        if key not in self.bone_index:
+            names = bones.keys()
+            self.bone_index[key] = (
+                np.array([i for i, name in enumerate(self.bone_names) if name in names], dtype=np.int64),
+                np.array([names.index(name) for name in self.bone_names if name in names], dtype=np.int64),
+            )
+            for bone in bones: bone.rotation_mode = 'QUATERNION'
+        bank_idx, bone_idx = self.bone_index[key]
+
+        pose = self.poses[index]
+        for prop, channel in channels.items():
+            size = channel.stop - channel.start
+            # keep the current values of the bones missing in the bank
+            values = np.empty(len(bones) * size, dtype=np.float32)
+            bones.foreach_get(prop, values)
+            values = values.reshape(-1, size)
+            values[bone_idx] = pose[bank_idx, channel]
+            bones.foreach_set(prop, values.ravel())
+        return self.sources[index]
+
+
+# function to load the pose bank from path, bake it from the actions and save it if path does not exist
+# a bank baked from other actions, frame ranges, keyframes or step is baked again
+def load_pose_bank(path, actions=None, step=1):
+    if actions is None: actions = list(bpy.data.actions)
+    if os.path.exists(path):
+        bank = PoseBank.load(path)
+        if bank.matches(actions, step): return bank
+        print("pose bank {} was baked from other actions or keyframes, baking it again".format(path))
+    bank = PoseBank.from_actions(actions, step)
+    bank.save(path)
+    return bank
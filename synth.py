@@ -1,7 +1,8 @@
 import os
 import sys
+import time
 import random
-import datetime
+import argparse
 
 import bpy
 
@@ -10,106 +11,268 @@ if not dir in sys.path:
     sys.path.append(dir)
 
 import importlib
+import keypoints
+importlib.reload(keypoints)
 import base_ops
 importlib.reload(base_ops)
 import xml_tools
 importlib.reload(xml_tools)
+import array_store
+importlib.reload(array_store)
+import pose_bank
+importlib.reload(pose_bank)
+import manifest
+importlib.reload(manifest)
+import timing
+importlib.reload(timing)
+import image_writer
+importlib.reload(image_writer)
 from base_ops import *
 from xml_tools import *
+from array_store import *
+from pose_bank import *
+from manifest import *
+from timing import *
+from image_writer import *
 
 
 class SynthData():
-    def __init__(self, num, debug=False, outpath="", hdr_path=""):
+    def __init__(self, num, debug=False, outpath="", hdr_path="", occlusion_backend="scene_raycast", single_pass=False, texture_path="",
+                 min_bbox_area=0.0, min_visible_keypoints=1, camera_retries=5, max_retries=20,
+                 annotation_format="xml", anim_path=None, anim_cache=None, pose_bank_path=None,
+                 hdr_budget=1024, worker_id=0, checkpoint=1000,
+                 profile_samples=0, async_writers=0, write_queue=8, png_level=6, image_format="png", depth_format="png",
+                 views=1, sequence_length=1, frame_step=1,
+                 camera_sampler="random", camera_candidates=64, min_coverage=.8, max_truncation=.1, target_area=(.05, .5),
+                 crowd=0, crowd_scope=2.5):
         self.debug = debug
         self.outpath = outpath
         self.hdr_path = hdr_path
+        # keypoint occlusion backend, "scene_raycast" or "bvh"
+        self.occlusion_backend = occlusion_backend
+        # random generator and seed of the current sample, see run
+        self.worker_id = worker_id
+        self.rng = random
+        self.seed = None
         # init scene
         scene = bpy.context.scene
         scene.use_nodes = True
+        self.num = num
         self.nodes = scene.node_tree.nodes
         self.nodes["Image Output"].base_path = outpath
         self.nodes["File Output"].base_path = outpath
-        # load env map
-        load_hdrs(self.hdr_path)
+        # render each view layer once per sample
+        self.scheduler = RenderScheduler()
+        self.render_count = 0
+        # comma separated annotation formats, "xml" writes one file per image, "jsonl" streams coco records
+        # into shards, "npy" writes memory mappable array shards, "both" is "xml,jsonl"
+        self.annotation_formats = set(annotation_format.replace("both", "xml,jsonl").split(","))
+        for fmt in self.annotation_formats:
+            if fmt not in ["xml", "jsonl", "npy"]:
+                raise ValueError("unknown annotation format: {}".format(fmt))
+        # the streaming writers only write on checkpoints, right before the done records of their samples
+        # so a sample interrupted before its done record has no annotation on disk
+        self.jsonl_writer = JsonlWriter(outpath, batch_size=None) if "jsonl" in self.annotation_formats else None
+        self.array_writer = ArrayShardWriter(os.path.join(outpath, "arrays"), shard_size=None) if "npy" in self.annotation_formats else None
+        # image, body part, mask and depth from one render via shader aovs
+        self.single_pass = single_pass
+        if self.single_pass:
+            setup_single_pass(texture_path)
+        # encode the render outputs in a pool of async_writers threads, blender writes raw exr files
+        self.writer_pool = None
+        self.image_ext = "png"
+        if async_writers > 0:
+            self.setup_writer_pool(async_writers, write_queue, png_level, image_format, depth_format)
+        # manifest of the generated samples, done records are held until the streaming writers are flushed
+        # the streaming writers are flushed every checkpoint samples
+        self.manifest = Manifest(outpath)
+        self.checkpoint = checkpoint
+        self.index = None
+        # why gen_data or gen_sequence rendered nothing, printed by run
+        self.reject_reason = None
+        # pre-render check thresholds, bbox area is normalized to the image area
+        self.min_bbox_area = min_bbox_area
+        self.min_visible_keypoints = min_visible_keypoints
+        # cameras rendered of every pose, every view is written as its own sample
+        self.views = views
+        # consecutive frames rendered of every posed scene with a fixed camera, every frame is written as its own sample
+        self.sequence_length = sequence_length
+        self.frame_step = frame_step
+        if views > 1 and sequence_length > 1:
+            raise ValueError("render either several views or a sequence of every posed scene")
+        # show crowd armatures, linked duplicates are added if the scene has less, 0 keeps the visible armatures
+        self.crowd = crowd
+        self.crowd_scope = crowd_scope
+        # "random" places one random camera, "framed" scores camera_candidates cameras and uses one that frames
+        # min_coverage of the keypoints, at most max_truncation of the bbox and a bbox area in target_area
+        if camera_sampler not in ["random", "framed"]:
+            raise ValueError("unknown camera sampler: {}".format(camera_sampler))
+        self.camera_sampler = camera_sampler
+        self.camera_candidates = camera_candidates
+        self.min_coverage = min_coverage
+        self.max_truncation = max_truncation
+        self.target_area = target_area
+        # resample the camera camera_retries times before resampling the pose
+        self.camera_retries = camera_retries
+        self.max_retries = max_retries
+        self.precheck_stats = {"accepted": 0, "rejected": 0, "render_time": 0.0, "renders": 0}
+        # per sample stage times, render and ray cast counts, the first profile_samples samples are profiled
+        self.timer = StageTimer(counters, profile_samples)
+        # load env map and list animations once, they are reused by every sample
+        self.hdrs = HdrManager(self.hdr_path, hdr_budget)
+        # load the fbx animations of anim_path, else use the actions of the blend file
+        if anim_path: load_animations(anim_path, anim_cache)
+        self.anims = list_animations()
+        # sample poses from a baked pose bank instead of baking an action and setting the frame
+        self.pose_bank = None
+        if pose_bank_path:
+            if sequence_length > 1:
+                raise ValueError("a sequence plays the animations, it can not be sampled from a pose bank")
+            self.pose_bank = load_pose_bank(pose_bank_path, [bpy.data.actions[name] for name in self.anims])
         # reset the export node value
         self.reset()
 
-    def reset(self):
+    def reset(self, name=None):
         # random select a hdr
-        random_hdr()
+        random_hdr(self.hdrs, self.rng)
+        if self.crowd > 0:
+            with self.timer.stage("show_crowd"):
+                show_crowd(self.crowd, self.rng)
         # clean all action
         for arma in list_armatures(True):
             arma.animation_data_clear()
 
         self.persons = []
-        self.file_name = generate_file_name()
-        # set name of output file
+        self.set_output_name(name if name is not None else generate_file_name())
+
+    # set the name of the output files, also the sample id in the manifest
+    def set_output_name(self, name):
+        self.file_name = name
+        self.sample_id = name
         self.nodes["Image Output"].file_slots[0].path = "img_{}".format(self.file_name)
         self.nodes["File Output"].file_slots[0].path = "body_{}".format(self.file_name)
         self.nodes["File Output"].file_slots[1].path = "mask_{}".format(self.file_name)
         self.nodes["File Output"].file_slots[2].path = "depth_{}".format(self.file_name)
 
+    # function to switch the file output nodes to raw exr and start the writer pool
+    def setup_writer_pool(self, workers, max_queue, level, image_format, depth_format):
+        view_transform = bpy.context.scene.view_settings.view_transform
+        if view_transform not in ['Standard', 'Raw']:
+            raise ValueError("async writers encode with the Standard or Raw view transform, the scene uses {}".format(view_transform))
+        for kind, fmt in [('color', image_format), ('depth', depth_format)]:
+            if fmt not in output_formats[kind]:
+                raise ValueError("{} output can not be written as {}".format(kind, fmt))
+        image_channels = set_raw_exr_output(self.nodes["Image Output"])
+        file_channels = set_raw_exr_output(self.nodes["File Output"])
+        # (node, slot, kind, format, channels) of every output, body part colors are labels and always lossless
+        # the mask is the instance id aov in single pass mode, else the silhouette of the mask view layer
+        self.raw_outputs = [
+            ("Image Output", 0, 'color', image_format, image_channels[0]),
+            ("File Output", 0, 'color', 'png', file_channels[0]),
+            ("File Output", 1, 'mask', 'png', 1 if self.single_pass else file_channels[1]),
+            ("File Output", 2, 'depth', depth_format, 1),
+        ]
+        self.png_level = level
+        self.srgb = view_transform == 'Standard'
+        self.image_ext = image_format
+        self.writer_pool = WriterPool(workers, max_queue)
+
+    # raw exr and encoded file name of every output of the sample
+    def raw_output_files(self):
+        frame = bpy.context.scene.frame_current
+        files = []
+        for node_name, slot, kind, fmt, channels in self.raw_outputs:
+            name = "{}{:04d}".format(self.nodes[node_name].file_slots[slot].path, frame)
+            files.append((name + ".exr", name + "." + fmt, kind, fmt, channels))
+        return files
+
+    # queue the encoding of the raw outputs of the sample, blocks while the queue is full
+    def submit_outputs(self):
+        for exr_name, out_name, kind, fmt, channels in self.raw_output_files():
+            self.writer_pool.submit(
+                self.sample_id,
+                exr_path=os.path.join(self.outpath, exr_name), out_path=os.path.join(self.outpath, out_name),
+                kind=kind, fmt=fmt, level=self.png_level, channels=channels, srgb=self.srgb,
+                instance_ids=kind == 'mask' and self.single_pass,
+            )
+
     def render(self):
         # render and save
         if not self.debug:
-            self.render_layers()
-            self.gen_xml()
+            with self.timer.stage("render_layers"):
+                self.render_layers()
+            if self.writer_pool is not None:
+                with self.timer.stage("write_queue"):
+                    self.submit_outputs()
+            with self.timer.stage("gen_xml"):
+                self.gen_xml()
         # set name of output file
         print("rendering folder path: ", os.path.join(self.outpath))
 
     def render_layers(self, main_viewlayer='ViewLayer', part_viewlayer='ViewLayer_part'):
-        armas = list_armatures(visible_only=True)
-        # render mask image
-        # choose armature object mesh
-        for obj in armas:
-            # if is mesh
-            for child in bpy.data.objects[obj.name].children:
-                if child.type == "MESH":
-                    # select mesh object
-                    bpy.context.view_layer.objects.active = child
-                    bpy.context.object.modifiers["GeometryNodes"]["Input_2"] = 1
-
-        easy_mask_mode()
-        single_render(part_viewlayer)
-
-        # render color image
-        for obj in armas:
-            for child in bpy.data.objects[obj.name].children:
-                if child.type == "MESH":
-                    bpy.context.view_layer.objects.active = child
-                    bpy.context.object.modifiers["GeometryNodes"]["Input_2"] = 0
-
-        # open depth of field
-        bpy.context.scene.camera.data.dof.use_dof = True
-        bpy.context.scene.render.film_transparent = False
-
-        # # open motion blur
-        # bpy.context.scene.render.use_motion_blur = True
-        # # open render noise
-        # bpy.context.scene.cycles.samples = 128
-        # # open denoise
-        # bpy.context.scene.cycles.use_denoising = True
-
-        bpy.context.scene.eevee.taa_render_samples = 128
-        bpy.context.scene.eevee.use_taa_reprojection = True
-        bpy.context.scene.eevee.use_motion_blur = True
-        
-        # bake settings to ADJACENT_FACES
-        bpy.context.scene.render.bake.margin_type = 'ADJACENT_FACES'
-        single_render(main_viewlayer)
+        armas = frame_context().armatures
+        start = time.perf_counter()
 
-    def gen_xml(self):
-        arma_list = list_armatures(visible_only=True)
-        for idx, arma in enumerate(arma_list):
+        # render mask image, body part, mask and depth are written by "File Output"
+        def mask_setup():
+            set_body_part_mode(armas, 1)
+            easy_mask_mode()
+
+        # render color image, written by "Image Output"
+        def color_setup():
+            set_body_part_mode(armas, 0)
+            easy_color_mode()
+
+        if self.single_pass:
+            self.scheduler.add(main_viewlayer, ["Image Output", "File Output"], color_setup)
+        else:
+            self.scheduler.add(part_viewlayer, ["File Output"], mask_setup)
+            self.scheduler.add(main_viewlayer, ["Image Output"], color_setup)
+        self.render_count = self.scheduler.run()
+        self.precheck_stats["render_time"] += time.perf_counter() - start
+        self.precheck_stats["renders"] += 1
+
+    # the mesh coordinates, bone positions and occlusion tree of the frame context are shared by every camera of the pose
+    def annotate(self):
+        ctx = frame_context()
+        persons = []
+        arma_list, bboxes = [], []
+        track_ids = []
+        for track_id, arma in enumerate(ctx.armatures):
             # get mesh object
-            mesh_obj = get_obj_from_armature(arma)[0]
-            bbox = get_bounding_box_2d(mesh_obj.name)
+            bbox = get_bounding_box_2d(ctx.meshes[arma.name][0].name, ctx=ctx)
             if bbox is None: continue
-            # get keypoint
-            pose = get_pose_to_dict(arma.name)
-            hand = get_hand_to_dict(arma.name)
-            person = Person(bbox, pose, hand)
-            self.persons.append(person)
+            arma_list.append(arma)
+            bboxes.append(bbox)
+            # the visible armatures do not change within a sequence, their index is the track id
+            track_ids.append(track_id if self.sequence_length > 1 else None)
+
+        # get keypoint of every armature with one occlusion pass
+        keypoints = get_keypoints_to_dict(arma_list, backend=self.occlusion_backend, ctx=ctx)
+        for arma, bbox, track_id in zip(arma_list, bboxes, track_ids):
+            pose, hand = keypoints[arma.name]
+            persons.append(Person(bbox, pose, hand, track_id))
+        return persons
+
+    # pre-render check, the sample is accepted if at least one person passes the thresholds
+    def precheck(self):
+        # update camera and armature matrices before projecting
+        bpy.context.view_layer.update()
+        self.persons = self.annotate()
+        for person in self.persons:
+            x1, y1, x2, y2 = person.bbox
+            if (x2 - x1) * (y2 - y1) < self.min_bbox_area: continue
+            visible = [
+                1 for x, y, occ in list(person.pose.values()) + list(person.hand.values())
+                if is_visible(x, y) and occ == 0
+            ]
+            if len(visible) >= self.min_visible_keypoints: return True
+        self.persons = []
+        return False
+
+    def gen_xml(self):
+        # the persons are annotated by precheck before rendering
+        if not self.persons: self.persons = self.annotate()
 
         # get render x y
         render_x = bpy.context.scene.render.resolution_x
@@ -119,38 +282,334 @@ class SynthData():
         # get render img channel
         render_c = 3 if render_format == "RGB" else 4
         # get output file name
-        save_xml(
-            self.persons,
-            "img_{}{:04d}.png".format(self.file_name, bpy.context.scene.frame_current),
-            self.outpath,
-            render_x, render_y, render_c
+        img_path = "img_{}{:04d}.{}".format(self.file_name, bpy.context.scene.frame_current, self.image_ext)
+        if "xml" in self.annotation_formats:
+            save_xml(self.persons, img_path, self.outpath, render_x, render_y, render_c, self.seed)
+        if self.jsonl_writer is not None:
+            self.jsonl_writer.write(coco_record(self.persons, img_path, render_x, render_y, render_c, self.seed))
+        if self.array_writer is not None:
+            self.array_writer.add(self.persons, img_path, render_x, render_y, render_c, self.seed)
+
+    # function to place the visible armatures, a crowd is scattered without overlapping footprints
+    def place_armatures(self):
+        if self.crowd > 0:
+            place_crowd(scope=self.crowd_scope, rotate=True, rng=self.rng)
+        else:
+            random_armature_position(rng=self.rng)
+
+    # sample ids of the views or frames of a sample name
+    def sample_ids(self, name):
+        if self.views > 1:
+            return ["{}_v{:02d}".format(name, view) for view in range(self.views)]
+        if self.sequence_length > 1:
+            return ["{}_f{:03d}".format(name, k) for k in range(self.sequence_length)]
+        return [name]
+
+    # function to sample cameras around the nose until one passes precheck, at most retries cameras
+    # the pose is resampled every camera_retries cameras if resample_pose
+    def sample_camera(self, retries, resample_pose=False):
+        for retry in range(retries):
+            # resample the pose if the camera retries of this pose failed
+            if resample_pose and retry > 0 and retry % self.camera_retries == 0:
+                self.random_pose()
+            # update camera
+            ctx = frame_context()
+            armature = ctx.armatures[0]
+            v3 = get_bone_pos_global(armature, 'nose', ctx=ctx)
+            with self.timer.stage("random_camera"):
+                if self.camera_sampler == "framed":
+                    self.framed_camera(armature, v3)
+                else:
+                    random_camera(dst_point=v3, offset_scope=0.1, pos_scale=1.5, rng=self.rng)
+            with self.timer.stage("precheck"):
+                accepted = self.precheck()
+            if accepted: return True
+            self.precheck_stats["rejected"] += 1
+        return False
+
+    # function to place the camera at a candidate that frames the armature, scored against its keypoints and mesh
+    def framed_camera(self, armature, target):
+        # the candidates are scored on the current pose
+        ctx = frame_context()
+        coords = ctx.mesh_coords(ctx.meshes[armature.name][0].name)
+        keypoints = ctx.bones_world(armature, body_bones + hand_bones)
+        return framed_camera(
+            dst_point=target, keypoints=keypoints, coords=coords, n=self.camera_candidates,
+            min_coverage=self.min_coverage, max_truncation=self.max_truncation, area_range=self.target_area,
+            offset_scope=0.1, pos_scale=1.5, rng=self.rng,
         )
 
-    def gen_data(self):
-        self.reset()
-        # show_armature(1)
-        random_animation()
-        set_frame_all(-1)
-        random_armature_position()
+    # function to pose the scene once and render a camera for every view
+    # return (sample id, manifest fields, output files) of the rendered views, empty if the sample is rejected
+    def gen_data(self, name=None):
+        with self.timer.stage("reset"):
+            self.reset(name)
+        self.random_pose()
+        with self.timer.stage("random_armature_position"):
+            self.place_armatures()
+
+        rendered = []
+        for view, view_name in enumerate(self.sample_ids(self.file_name)):
+            # the first view may resample the pose, the later views keep the pose and only skip a failed camera
+            if view == 0:
+                accepted = self.sample_camera(self.max_retries + 1, resample_pose=True)
+            else:
+                accepted = self.sample_camera(self.camera_retries)
+            if not accepted:
+                # no configuration passed, skip the sample without rendering
+                if view == 0:
+                    self.reject_reason = "rejected by precheck after {} retries".format(self.max_retries)
+                    return rendered
+                continue
+
+            self.precheck_stats["accepted"] += 1
+            self.set_output_name(view_name)
+            # a view done in an earlier run is not rendered again, its camera is still sampled to keep the random sequence
+            if self.manifest.finished(view_name): continue
+            self.manifest.record(view_name, 'started', index=self.index, seed=self.seed, view=view, files=self.output_files(raw=True))
+            self.render()
+            rendered.append((view_name, {"view": view} if self.views > 1 else {}, self.output_files()))
+        if not rendered: self.reject_reason = "the later views are rejected by precheck or done in an earlier run"
+        return rendered
+
+    # function to get the frames of a sequence, a window of sequence_length frames frame_step apart
+    # the window lies in the frame range of the action of every visible armature, None if it does not fit
+    def sequence_frames(self):
+        actions = [arma.animation_data.action for arma in list_armatures(visible_only=True)]
+        # skip the first frames like set_frame
+        first = max(int(action.frame_range[0]) + 2 for action in actions)
+        last = min(int(action.frame_range[1]) for action in actions)
+        # later frames past the end of an action would repeat its last pose
+        if last - first < (self.sequence_length - 1) * self.frame_step: return None
+        start = self.rng.randint(first, last - (self.sequence_length - 1) * self.frame_step)
+        return [start + k * self.frame_step for k in range(self.sequence_length)]
+
+    # function to pose the scene once and render consecutive frames of its animations
+    # camera, lights and hdr are sampled once for the first frame, only the pose state is recomputed per frame
+    # return (sample id, manifest fields, output files) of the rendered frames, empty if the first frame is rejected
+    def gen_sequence(self, name=None):
+        with self.timer.stage("reset"):
+            self.reset(name)
+        self.random_pose()
+        with self.timer.stage("random_armature_position"):
+            self.place_armatures()
+        frames = self.sequence_frames()
+        if frames is None:
+            self.reject_reason = "the animations are shorter than the sequence"
+            return []
+        with self.timer.stage("set_frame"):
+            bpy.context.scene.frame_set(frames[0])
+        # the sequence keeps its pose, only the camera is resampled
+        if not self.sample_camera(self.max_retries + 1):
+            self.reject_reason = "rejected by precheck after {} retries".format(self.max_retries)
+            return []
+        self.precheck_stats["accepted"] += 1
+
+        rendered = []
+        for k, (sample_id, frame) in enumerate(zip(self.sample_ids(self.file_name), frames)):
+            if k > 0:
+                with self.timer.stage("set_frame"):
+                    bpy.context.scene.frame_set(frame)
+                # every frame is annotated, the persons may leave the view
+                with self.timer.stage("precheck"):
+                    self.persons = self.annotate()
+            # the output files are numbered by frame, the sample id is per frame
+            self.sample_id = sample_id
+            if self.manifest.finished(sample_id): continue
+            self.manifest.record(sample_id, 'started', index=self.index, seed=self.seed, frame=frame, files=self.output_files(raw=True))
+            self.render()
+            rendered.append((sample_id, {"frame": frame}, self.output_files()))
+        return rendered
+
+    def random_pose(self):
+        if self.pose_bank is None:
+            with self.timer.stage("random_animation"):
+                random_animation(self.anims, self.rng)
+            with self.timer.stage("set_frame_all"):
+                set_frame_all(-1, self.rng)
+            return
+        with self.timer.stage("pose_bank"):
+            for arma in list_armatures(visible_only=True):
+                self.pose_bank.apply(arma, self.pose_bank.sample(self.rng))
+            bpy.context.view_layer.update()
+            invalidate_frame_context()
 
-        # update camera
-        armature = list_armatures(visible_only=True)[0]
-        v3 = get_bone_pos_global(armature, 'nose')
-        random_camera(dst_point=v3, offset_scope=0.1, pos_scale=1.5)
+    def precheck_report(self):
+        stats = self.precheck_stats
+        total = stats["accepted"] + stats["rejected"]
+        # every rejected configuration would have cost one sample render
+        mean_render_time = stats["render_time"] / stats["renders"] if stats["renders"] else 0
+        print("precheck: accepted {}/{} ({:.1%}), estimated render time saved: {:.3f}s".format(
+            stats["accepted"], total, stats["accepted"] / total if total else 0, stats["rejected"] * mean_render_time))
 
-        self.render()
+
+    # file names of the sample in outpath, written by the file output nodes and save_xml
+    # raw adds the exr files of the writer pool, they only exist until they are encoded
+    def output_files(self, raw=False):
+        if self.writer_pool is None:
+            files = output_file_names(self.nodes["Image Output"]) + output_file_names(self.nodes["File Output"])
+        else:
+            files = [out_name for _, out_name, _, _, _ in self.raw_output_files()]
+            if raw: files += [exr_name for exr_name, _, _, _, _ in self.raw_output_files()]
+        if "xml" in self.annotation_formats:
+            files.append("img_{}{:04d}.xml".format(self.file_name, bpy.context.scene.frame_current))
+        return files
+
+    # write the done records of the samples whose annotations and images are on disk
+    def commit_samples(self):
+        buffered = (self.jsonl_writer is not None and self.jsonl_writer.buffer) or \
+                   (self.array_writer is not None and self.array_writer.names)
+        if buffered: return
+        self.manifest.commit(self.writer_pool.done if self.writer_pool is not None else None)
+
+    # write the buffered annotations of the streaming writers and commit their samples
+    # the writer pool is joined first, so every flushed sample gets its done record
+    def flush_writers(self):
+        if self.writer_pool is not None: self.writer_pool.join()
+        if self.jsonl_writer is not None: self.jsonl_writer.flush()
+        if self.array_writer is not None: self.array_writer.flush()
+        self.commit_samples()
+
+    # write the buffered annotations of the streaming writers and wait for the writer pool
+    def close_writers(self):
+        if self.writer_pool is not None: self.writer_pool.close()
+        if self.jsonl_writer is not None: self.jsonl_writer.close()
+        if self.array_writer is not None: self.array_writer.close()
+        self.commit_samples()
+        self.manifest.close()
+
+    # stop after an error or interrupt, wait for the writer pool and drop the buffered annotations
+    # the samples of the dropped annotations have no done record, they are cleaned and generated again on resume
+    def abort_writers(self):
+        if self.writer_pool is not None:
+            try:
+                self.writer_pool.close()
+            except RuntimeError as e:
+                print(e)
+        if self.jsonl_writer is not None or self.array_writer is not None:
+            if self.jsonl_writer is not None:
+                self.jsonl_writer.buffer = []
+                self.jsonl_writer.close()
+            if self.array_writer is not None: self.array_writer.clear()
+            self.manifest.drop()
+        self.commit_samples()
+        self.manifest.close()
+
+    def run(self, num=None, seed=None, start_index=0):
+        # generate num samples in this process, the scene and loaded data are kept between samples
+        # if seed is given, sample i is generated with its own generator sample_rng(seed, worker_id, i) and named
+        # sample_name(seed, worker_id, i), starting at start_index, so one sample can be generated again with
+        # --seed, --worker_id, --start_index and --num 1
+        # samples rejected by precheck are skipped, until num samples are rendered
+        # the files of samples interrupted in an earlier run are removed, with seed they are generated again
+        # and the samples done or rejected in the manifest are skipped, the done samples count toward num
+        if num is None: num = self.num
+        cleaned = self.manifest.clean_partial(self.outpath)
+        if cleaned: print("removed the files of {} interrupted samples".format(cleaned))
+        use_times = []
+        start = time.perf_counter()
+        i, skipped, resumed = start_index, 0, 0
+        while len(use_times) + resumed < num:
+            name = None
+            self.index = i
+            if seed is not None:
+                name = sample_name(seed, self.worker_id, i)
+                # views or frames done in an earlier run
+                resumed += self.manifest.done_count(self.sample_ids(name))
+                if self.manifest.skip(name, self.sample_ids(name)):
+                    i += 1
+                    continue
+                self.seed = sample_seed(seed, self.worker_id, i)
+                self.rng = sample_rng(seed, self.worker_id, i)
+            i += 1
+            sample_start = time.perf_counter()
+            self.timer.begin_sample()
+            self.reject_reason = None
+            rendered = self.gen_sequence(name) if self.sequence_length > 1 else self.gen_data(name)
+            self.timer.end_sample(bool(rendered))
+            if not rendered:
+                self.manifest.record(self.file_name, 'rejected', index=self.index, seed=self.seed)
+                skipped += 1
+                print("sample {} (index {}): {}".format(self.file_name, self.index, self.reject_reason))
+                if skipped > 10 * num: raise RuntimeError("precheck rejects every sample, check the thresholds")
+                continue
+            # the scene setup is shared by the views, every view gets an equal part of the time
+            use_time = (time.perf_counter() - sample_start) / len(rendered)
+            for sample_id, fields, files in rendered:
+                use_times.append(use_time)
+                self.manifest.hold(sample_id, index=self.index, seed=self.seed, files=files, render_time=use_time, **fields)
+                if len(use_times) % self.checkpoint == 0: self.flush_writers()
+                print("sample {}/{}: {}, renders: {}, use time: {:.3f}s, {:.3f} img/s".format(
+                    len(use_times) + resumed, num, sample_id, self.render_count, use_time, 1 / use_time))
+            self.commit_samples()
+
+        self.close_writers()
+        total_time = time.perf_counter() - start
+        print("total: {} samples, {} done in earlier runs, use time: {:.3f}s, {:.3f} img/s".format(
+            num, resumed, total_time, len(use_times) / total_time if total_time > 0 else 0))
+        self.precheck_report()
+        if self.writer_pool is not None:
+            print("writer pool: {} files, renderer stalled {:.3f}s on a full queue".format(
+                self.writer_pool.written, self.writer_pool.stall_time))
+        # stage report next to the dataset
+        print(self.timer.format_report(self.timer.save(self.outpath)))
+        return use_times
 
 
 if __name__ == "__main__":
-    # parse args
     base_dir = os.path.dirname(bpy.data.filepath)
-    output_path = os.path.join(base_dir, "data")
-    hdr_path = os.path.join(base_dir, "hdrs")
-
-    ss = SynthData(1, debug=False, outpath=output_path, hdr_path=hdr_path)
-    current_time = datetime.datetime.now()
-    ss.gen_data()
-    use_time = (datetime.datetime.now() - current_time).microseconds
-    # to second
-    use_time = use_time / 1000000
-    print("use time: ", use_time)
+    # parse args, blender passes the script arguments after "--"
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="generate synthetic data, run with: blender -b <file> --python synth.py -- --num 10")
+    parser.add_argument("--num", type=int, default=1, help="number of samples to generate")
+    parser.add_argument("--outpath", default=os.path.join(base_dir, "data"))
+    parser.add_argument("--hdr_path", default=os.path.join(base_dir, "hdrs"))
+    parser.add_argument("--hdr_budget", type=float, default=1024, help="memory budget of the loaded hdrs in MB")
+    parser.add_argument("--occlusion_backend", default="scene_raycast", choices=occlusion_backends)
+    parser.add_argument("--seed", type=int, default=None, help="global seed, every sample gets its own seed from it")
+    parser.add_argument("--worker_id", type=int, default=0, help="worker id of the sample seeds and names")
+    parser.add_argument("--start_index", type=int, default=0, help="index of the first sample")
+    parser.add_argument("--profile", type=int, default=0, help="profile the first n samples with cProfile, written to profile.prof")
+    parser.add_argument("--async_writers", type=int, default=0, help="encode the render outputs in n writer threads, 0 lets blender write them")
+    parser.add_argument("--write_queue", type=int, default=8, help="queued outputs of the writer threads before the renderer waits")
+    parser.add_argument("--png_level", type=int, default=6, help="zlib compression level of the async png outputs")
+    parser.add_argument("--image_format", default="png", choices=output_formats['color'], help="format of the async color image")
+    parser.add_argument("--depth_format", default="png", choices=output_formats['depth'], help="format of the async depth, png is 16 bit")
+    parser.add_argument("--views", type=int, default=1, help="cameras rendered of every posed scene")
+    parser.add_argument("--sequence_length", type=int, default=1, help="consecutive frames rendered of every posed scene")
+    parser.add_argument("--frame_step", type=int, default=1, help="frames between two rendered frames of a sequence")
+    parser.add_argument("--camera_sampler", default="random", choices=["random", "framed"], help="framed scores many cameras and keeps one that frames the person")
+    parser.add_argument("--camera_candidates", type=int, default=64, help="cameras scored by the framed sampler")
+    parser.add_argument("--min_coverage", type=float, default=.8, help="minimum fraction of the keypoints in view of a framed camera")
+    parser.add_argument("--max_truncation", type=float, default=.1, help="maximum fraction of the bbox outside of the frame of a framed camera")
+    parser.add_argument("--target_area", type=float, nargs=2, default=[.05, .5], help="range of the normalized bbox area of a framed camera")
+    parser.add_argument("--crowd", type=int, default=0, help="persons of every sample, linked duplicates are added if the scene has less")
+    parser.add_argument("--crowd_scope", type=float, default=2.5, help="half size of the square the crowd is scattered in")
+    parser.add_argument("--checkpoint", type=int, default=1000, help="samples between flushes of the jsonl and npy annotations")
+    parser.add_argument("--single_pass", action="store_true", help="render image, body part, mask and depth in one render")
+    parser.add_argument("--texture_path", default=os.path.join(base_dir, "texture"))
+    parser.add_argument("--min_bbox_area", type=float, default=0.0, help="minimum normalized bbox area of a person")
+    parser.add_argument("--anim_path", default=None, help="directory of fbx animations, default: the actions of the blend file")
+    parser.add_argument("--anim_cache", default=None, help="library cache directory of the fbx animations")
+    parser.add_argument("--pose_bank", default=None, help="pose bank .npz, baked from the animations if it does not exist")
+    parser.add_argument("--annotation_format", default="xml", help="comma separated list of xml, jsonl, npy, or both for xml,jsonl")
+    parser.add_argument("--min_visible_keypoints", type=int, default=1, help="minimum visible keypoints of a person")
+    args = parser.parse_args(argv)
+
+    ss = SynthData(args.num, debug=False, outpath=args.outpath, hdr_path=args.hdr_path, occlusion_backend=args.occlusion_backend,
+                   single_pass=args.single_pass, texture_path=args.texture_path,
+                   min_bbox_area=args.min_bbox_area, min_visible_keypoints=args.min_visible_keypoints,
+                   annotation_format=args.annotation_format, anim_path=args.anim_path, anim_cache=args.anim_cache,
+                   pose_bank_path=args.pose_bank, hdr_budget=args.hdr_budget, worker_id=args.worker_id,
+                   checkpoint=args.checkpoint, profile_samples=args.profile,
+                   async_writers=args.async_writers, write_queue=args.write_queue, png_level=args.png_level,
+                   image_format=args.image_format, depth_format=args.depth_format, views=args.views,
+                   sequence_length=args.sequence_length, frame_step=args.frame_step,
+                   camera_sampler=args.camera_sampler, camera_candidates=args.camera_candidates, min_coverage=args.min_coverage,
+                   max_truncation=args.max_truncation, target_area=tuple(args.target_area),
+                   crowd=args.crowd, crowd_scope=args.crowd_scope)
+    try:
+        ss.run(seed=args.seed, start_index=args.start_index)
+    except BaseException:
+        ss.abort_writers()
+        raise
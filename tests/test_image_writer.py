@@ -0,0 +1,154 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from image_writer import *
+
+
+# function to write an uncompressed single part scanline exr of {channel name: (H, W) array}
+def write_exr(path, layers, version_flags=0, compression=0):
+    names = sorted(layers)
+    height, width = layers[names[0]].shape
+    types = {np.dtype(np.uint32): 0, np.dtype(np.float16): 1, np.dtype(np.float32): 2}
+
+    def attribute(name, attr_type, value):
+        return name.encode() + b"\0" + attr_type.encode() + b"\0" + struct.pack("<i", len(value)) + value
+
+    channels = b"".join(
+        name.encode() + b"\0" + struct.pack("<iBBBBii", types[layers[name].dtype], 0, 0, 0, 0, 1, 1) for name in names
+    ) + b"\0"
+    header = struct.pack("<ii", exr_magic, 2 | version_flags)
+    header += attribute("channels", "chlist", channels)
+    header += attribute("compression", "compression", bytes([compression]))
+    header += attribute("dataWindow", "box2i", struct.pack("<iiii", 0, 0, width - 1, height - 1))
+    header += attribute("displayWindow", "box2i", struct.pack("<iiii", 0, 0, width - 1, height - 1))
+    header += attribute("lineOrder", "lineOrder", bytes([0]))
+    header += b"\0"
+
+    chunks = [
+        struct.pack("<i", y) + struct.pack("<i", 0) + b"".join(layers[name][y].astype(layers[name].dtype.newbyteorder("<")).tobytes() for name in names)
+        for y in range(height)
+    ]
+    chunks = [chunk[:4] + struct.pack("<i", len(chunk) - 8) + chunk[8:] for chunk in chunks]
+    start = len(header) + 8 * height
+    offsets, pos = [], start
+    for chunk in chunks:
+        offsets.append(pos)
+        pos += len(chunk)
+    with open(path, "wb") as f:
+        f.write(header + struct.pack("<{}Q".format(height), *offsets) + b"".join(chunks))
+
+
+# function to decode a png of encode_png, return (H, W, C) or (H, W) array, and the palette or None
+def read_png(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos, idat, palette = 8, b"", None
+    while pos < len(data):
+        size, = struct.unpack_from(">I", data, pos)
+        chunk_type, body = data[pos + 4:pos + 8], data[pos + 8:pos + 8 + size]
+        crc, = struct.unpack_from(">I", data, pos + 8 + size)
+        assert crc == zlib.crc32(chunk_type + body)
+        if chunk_type == b"IHDR":
+            width, height, bit_depth, color_type = struct.unpack(">IIBB", body[:10])
+        elif chunk_type == b"PLTE":
+            palette = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3)
+        elif chunk_type == b"IDAT":
+            idat += body
+        pos += 12 + size
+    channel = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    rows = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, -1)
+    # encode_png writes filter type 0 only
+    assert (rows[:, 0] == 0).all()
+    array = rows[:, 1:].copy().view('>u2' if bit_depth == 16 else np.uint8).reshape(height, width, channel)
+    array = array.astype(np.uint16 if bit_depth == 16 else np.uint8)
+    return (array[..., 0] if channel == 1 else array), palette
+
+
+def test_read_exr_rgba_float(tmp_path):
+    rng = np.random.RandomState(0)
+    layers = {name: rng.rand(5, 7).astype(np.float32) for name in "RGBA"}
+    layers["Z"] = rng.rand(5, 7).astype(np.float16)
+    path = str(tmp_path / "a.exr")
+    write_exr(path, layers)
+    result = read_exr(path)
+    assert sorted(result) == sorted(layers)
+    for name, value in layers.items():
+        assert result[name].dtype == value.dtype
+        np.testing.assert_array_equal(result[name], value)
+
+
+def test_read_exr_flags(tmp_path):
+    layers = {"R": np.ones((2, 3), dtype=np.float32)}
+    # long attribute names are read like short ones
+    path = str(tmp_path / "long.exr")
+    write_exr(path, layers, version_flags=0x400)
+    np.testing.assert_array_equal(read_exr(path)["R"], layers["R"])
+    for flag in [0x200, 0x800, 0x1000]:
+        path = str(tmp_path / "{}.exr".format(flag))
+        write_exr(path, layers, version_flags=flag)
+        with pytest.raises(ValueError):
+            read_exr(path)
+    path = str(tmp_path / "zip.exr")
+    write_exr(path, layers, compression=3)
+    with pytest.raises(ValueError):
+        read_exr(path)
+
+
+def test_encode_png_16bit(tmp_path):
+    array = np.arange(6 * 4, dtype=np.uint16).reshape(6, 4) * 2731
+    path = tmp_path / "depth.png"
+    path.write_bytes(encode_png(array, level=9))
+    decoded, palette = read_png(str(path))
+    assert palette is None
+    assert decoded.dtype == np.uint16
+    np.testing.assert_array_equal(decoded, array)
+
+
+def test_encode_png_palette(tmp_path):
+    array = np.array([[0, 1, 2], [3, 255, 0]], dtype=np.uint8)
+    path = tmp_path / "mask.png"
+    path.write_bytes(encode_png(array, palette=mask_palette()))
+    decoded, palette = read_png(str(path))
+    np.testing.assert_array_equal(decoded, array)
+    np.testing.assert_array_equal(palette, mask_palette())
+    assert (palette[0] == 0).all()
+
+
+def test_convert_output_color(tmp_path):
+    rng = np.random.RandomState(1)
+    layers = {name: rng.rand(4, 5).astype(np.float32) for name in "RGBA"}
+    exr_path, out_path = str(tmp_path / "img.exr"), str(tmp_path / "img.png")
+    write_exr(exr_path, layers)
+    convert_output(exr_path, out_path, 'color', channels=4)
+    assert not os.path.exists(exr_path)
+    decoded, _ = read_png(out_path)
+    # exr color is premultiplied, png alpha is straight
+    color = np.stack([layers[name] for name in "RGBA"], axis=-1)
+    color[..., :3] = srgb_encode(np.clip(color[..., :3] / color[..., 3:], 0, 1))
+    np.testing.assert_array_equal(decoded, quantize(color, 8))
+
+
+def test_convert_output_mask(tmp_path):
+    # silhouette of the mask view layer, white person with an anti-aliased premultiplied edge over transparent background
+    silhouette = np.array([[0, .5, 1], [1, .25, 0]], dtype=np.float32)
+    exr_path, out_path = str(tmp_path / "mask.exr"), str(tmp_path / "mask.png")
+    write_exr(exr_path, {"R": silhouette, "G": silhouette, "B": silhouette, "A": silhouette})
+    convert_output(exr_path, out_path, 'mask', channels=4)
+    decoded, palette = read_png(out_path)
+    assert palette is None and decoded.shape == (2, 3, 2)
+    # the edge stays white, only its alpha is partial
+    np.testing.assert_array_equal(decoded[..., 0], np.where(silhouette > 0, 255, 0))
+    np.testing.assert_array_equal(decoded[..., 1], quantize(silhouette))
+
+    # instance ids of the single pass aov, id / 255
+    ids = np.array([[0, 1, 2], [3, 0, 1]])
+    write_exr(exr_path, {"R": (ids / 255).astype(np.float32)})
+    convert_output(exr_path, out_path, 'mask', instance_ids=True)
+    decoded, palette = read_png(out_path)
+    np.testing.assert_array_equal(decoded, ids)
+    np.testing.assert_array_equal(palette, mask_palette())
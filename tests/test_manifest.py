@@ -0,0 +1,92 @@
+import os
+
+from manifest import *
+
+
+def touch(out_dir, names):
+    for name in names:
+        with open(os.path.join(out_dir, name), "w") as f:
+            f.write("x")
+
+
+def test_interrupted_sample_is_cleaned(tmp_path):
+    out_dir = str(tmp_path)
+    manifest = Manifest(out_dir)
+    files = ["img_s0_w000_00000000.png", "img_s0_w000_00000000.xml"]
+    manifest.record("s0_w000_00000000", 'started', index=0, seed=1, files=files)
+    touch(out_dir, files)
+    manifest.close()
+
+    # a new run sees the started sample as interrupted
+    manifest = Manifest(out_dir)
+    assert [record["id"] for record in manifest.partial()] == ["s0_w000_00000000"]
+    assert not manifest.finished("s0_w000_00000000")
+    assert manifest.clean_partial(out_dir) == 1
+    assert not any(os.path.exists(os.path.join(out_dir, name)) for name in files)
+    assert manifest.status("s0_w000_00000000") == 'cleaned'
+    assert manifest.partial() == []
+    manifest.close()
+    assert read_manifest(os.path.join(out_dir, manifest_name))["s0_w000_00000000"]["status"] == 'cleaned'
+
+
+def test_rejected_sample_is_skipped(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.record("s0_w000_00000001", 'rejected', index=1, seed=2)
+    # the views of a rejected sample are never recorded
+    sample_ids = ["s0_w000_00000001_v00", "s0_w000_00000001_v01"]
+    assert manifest.skip("s0_w000_00000001", sample_ids)
+    assert manifest.done_count(sample_ids) == 0
+    manifest.close()
+
+
+def test_partially_done_views(tmp_path):
+    out_dir = str(tmp_path)
+    sample_ids = ["s0_w000_00000002_v{:02d}".format(view) for view in range(3)]
+    manifest = Manifest(out_dir)
+    manifest.record(sample_ids[0], 'started', files=["a_v00.png"])
+    manifest.record(sample_ids[0], 'done', files=["a_v00.png"])
+    manifest.record(sample_ids[1], 'started', files=["a_v01.png"])
+    touch(out_dir, ["a_v00.png", "a_v01.png"])
+    manifest.close()
+
+    manifest = Manifest(out_dir)
+    manifest.clean_partial(out_dir)
+    # the done view counts toward num, the interrupted and missing views are generated again
+    assert os.path.exists(os.path.join(out_dir, "a_v00.png"))
+    assert not os.path.exists(os.path.join(out_dir, "a_v01.png"))
+    assert manifest.done_count(sample_ids) == 1
+    assert not manifest.skip("s0_w000_00000002", sample_ids)
+    for sample_id in sample_ids[1:]:
+        manifest.record(sample_id, 'done')
+    assert manifest.done_count(sample_ids) == 3
+    assert manifest.skip("s0_w000_00000002", sample_ids)
+    manifest.close()
+    assert [record["id"] for record in read_done(out_dir)] == sample_ids
+
+
+def test_done_records_are_held_until_commit(tmp_path):
+    out_dir = str(tmp_path)
+    manifest = Manifest(out_dir)
+    for sample_id in ["a", "b"]:
+        manifest.record(sample_id, 'started')
+        manifest.hold(sample_id, index=0)
+    assert manifest.status("a") == 'started'
+    # b is still written by the writer pool
+    manifest.commit(lambda sample_id: sample_id != "b")
+    assert manifest.status("a") == 'done' and manifest.status("b") == 'started'
+    # an interrupted run drops the held records, b is cleaned on resume
+    manifest.drop()
+    manifest.commit()
+    manifest.close()
+    manifest = Manifest(out_dir)
+    assert [record["id"] for record in manifest.partial()] == ["b"]
+    manifest.close()
+
+
+def test_partly_written_line_is_skipped(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.record("a", 'done')
+    manifest.close()
+    with open(os.path.join(str(tmp_path), manifest_name), "a") as f:
+        f.write('{"id": "b", "sta')
+    assert list(read_manifest(os.path.join(str(tmp_path), manifest_name))) == ["a"]
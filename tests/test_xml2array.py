@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+from keypoints import *
+from xml_tools import Person, save_xml
+from array_store import ArrayDataset
+from xml2array import convert
+
+
+def make_person(i, track_id=None):
+    pose = {name: (0.1 + 0.01 * i, 0.2 + 0.01 * j, 0) for j, name in enumerate(body_labels[:3])}
+    hand = {hand_bones[0]: (0.5, 0.5, 1)}
+    return Person([0.1, 0.2, 0.3 + 0.01 * i, 0.4], pose, hand, track_id=track_id)
+
+
+# writes num xml files of one person each, the second person of every third file has a track id
+def write_xml_dir(xml_dir, num):
+    os.makedirs(xml_dir)
+    for i in range(num):
+        objects = [make_person(i)]
+        if i % 3 == 0: objects.append(make_person(i, track_id=i))
+        save_xml(objects, "img_{:04d}.png".format(i), xml_dir, 640, 480, 3, seed=1000 + i)
+
+
+def read_manifest_json(out_dir):
+    with open(os.path.join(out_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+def test_round_trip(tmp_path):
+    xml_dir, out_dir = str(tmp_path / "xml"), str(tmp_path / "arrays")
+    write_xml_dir(xml_dir, 7)
+    assert convert(xml_dir, out_dir, shard_size=3, workers=2) == 7
+
+    manifest = read_manifest_json(out_dir)
+    assert [shard["name"] for shard in manifest["shards"]] == ["shard_00000", "shard_00001", "shard_00002"]
+    assert manifest["images"] == 7 and manifest["persons"] == 10
+    assert manifest["failed"] == []
+
+    dataset = ArrayDataset(out_dir)
+    assert len(dataset) == 10
+    items = [dataset[i] for i in range(len(dataset))]
+    assert [item["file_name"] for item in items[:3]] == ["img_0000.png", "img_0000.png", "img_0001.png"]
+    assert [item["track_id"] for item in items[:3]] == [-1, 0, -1]
+    assert items[2]["seed"] == 1001
+    assert list(items[2]["size"]) == [640, 480, 3]
+    np.testing.assert_allclose(items[2]["bbox"], [0.1, 0.2, 0.31, 0.4], rtol=1e-6)
+    body = items[2]["body"]
+    np.testing.assert_allclose(body[1], [0.11, 0.21, 0], rtol=1e-6)
+    assert np.isnan(body[len(body_labels) - 1]).all()
+    np.testing.assert_allclose(items[2]["hand"][0], [0.5, 0.5, 1])
+
+
+def test_merged_image_index(tmp_path):
+    xml_dir, out_dir = str(tmp_path / "xml"), str(tmp_path / "arrays")
+    write_xml_dir(xml_dir, 7)
+    convert(xml_dir, out_dir, shard_size=3, workers=2)
+
+    dataset = ArrayDataset(out_dir)
+    # image_index points into the image tables of all shards, in file order
+    image_index = dataset.field('image_index')
+    assert list(image_index) == [0, 0, 1, 2, 3, 3, 4, 5, 6, 6]
+    names = ["img_{:04d}.png".format(i) for i in image_index]
+    assert [dataset[i]["file_name"] for i in range(len(dataset))] == names
+
+
+def test_resume_with_stored_shard_size(tmp_path):
+    xml_dir, out_dir = str(tmp_path / "xml"), str(tmp_path / "arrays")
+    write_xml_dir(xml_dir, 7)
+    convert(xml_dir, out_dir, shard_size=3, workers=2)
+    mtimes = {name: os.stat(os.path.join(out_dir, name, "boxes.npy")).st_mtime_ns for name in ["shard_00000", "shard_00001"]}
+
+    # an interrupted run is missing its last shard, only that one is converted again
+    shutil.rmtree(os.path.join(out_dir, "shard_00002"))
+    convert(xml_dir, out_dir, shard_size=3, workers=2)
+    for name in mtimes:
+        assert os.stat(os.path.join(out_dir, name, "boxes.npy")).st_mtime_ns == mtimes[name]
+    assert read_manifest_json(out_dir)["images"] == 7
+
+    with pytest.raises(ValueError):
+        convert(xml_dir, out_dir, shard_size=4, workers=2)
+
+
+def test_failed_files_are_retried(tmp_path):
+    xml_dir, out_dir = str(tmp_path / "xml"), str(tmp_path / "arrays")
+    write_xml_dir(xml_dir, 7)
+    broken = os.path.join(xml_dir, "img_0004.xml")
+    with open(broken) as f:
+        content = f.read()
+    with open(broken, "w") as f:
+        f.write(content[:len(content) // 2])
+    convert(xml_dir, out_dir, shard_size=3, workers=2)
+
+    manifest = read_manifest_json(out_dir)
+    assert manifest["failed"] == ["img_0004.xml"]
+    assert manifest["images"] == 6
+    assert [shard["failed"] for shard in manifest["shards"]] == [[], ["img_0004.xml"], []]
+
+    # the rerun converts the shard of the fixed file again
+    with open(broken, "w") as f:
+        f.write(content)
+    convert(xml_dir, out_dir, shard_size=3, workers=2)
+    manifest = read_manifest_json(out_dir)
+    assert manifest["failed"] == []
+    assert manifest["images"] == 7 and manifest["persons"] == 10
+    assert len(ArrayDataset(out_dir)) == 10
@@ -0,0 +1,108 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# file names of the timing report and the profile in the output directory
+report_name = "timing.json"
+profile_name = "profile.prof"
+
+
+# per sample stage timers and counters of the generator
+# stage times of one sample are summed, a stage can run several times per sample, e.g. random_camera on retries
+class StageTimer():
+    def __init__(self, counters=None, profile_samples=0):
+        # counters is a dict of running totals, e.g. base_ops.counters, its per sample increase is recorded
+        self.counters = counters if counters is not None else {}
+        # the first profile_samples samples are profiled with cProfile
+        self.profile_samples = profile_samples
+        self.profiler = cProfile.Profile() if profile_samples > 0 else None
+        self.samples = []
+        self.start = time.perf_counter()
+        self.sample = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sample is not None:
+                times = self.sample["stages"]
+                times[name] = times.get(name, 0.0) + time.perf_counter() - start
+
+    def begin_sample(self):
+        self.sample = {"stages": {}, "counters": dict(self.counters), "start": time.perf_counter()}
+        if self.profiler is not None and len(self.samples) < self.profile_samples:
+            self.profiler.enable()
+
+    # finish the current sample, rendered is False for a sample rejected by precheck
+    def end_sample(self, rendered=True):
+        if self.sample is None: return
+        if self.profiler is not None: self.profiler.disable()
+        sample = self.sample
+        self.sample = None
+        self.samples.append({
+            "total": time.perf_counter() - sample["start"],
+            "rendered": rendered,
+            "stages": sample["stages"],
+            "counters": {name: self.counters[name] - value for name, value in sample["counters"].items()},
+        })
+
+    def report(self):
+        total_time = time.perf_counter() - self.start
+        rendered = [sample for sample in self.samples if sample["rendered"]]
+        stage_names = []
+        for sample in self.samples:
+            stage_names += [name for name in sample["stages"] if name not in stage_names]
+
+        def summary(values):
+            values = np.asarray(values, dtype=np.float64)
+            if len(values) == 0: return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "total": 0.0}
+            return {
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "total": float(values.sum()),
+            }
+
+        return {
+            "samples": len(self.samples),
+            "rendered": len(rendered),
+            "total_time": total_time,
+            "samples_per_sec": len(rendered) / total_time if total_time > 0 else 0.0,
+            "sample": summary([sample["total"] for sample in rendered]),
+            "stages": {name: summary([sample["stages"].get(name, 0.0) for sample in self.samples]) for name in stage_names},
+            "counters": {name: summary([sample["counters"][name] for sample in self.samples]) for name in self.counters},
+        }
+
+    # write the report, and the profile if profiled, to out_dir and return the report
+    def save(self, out_dir):
+        report = self.report()
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, report_name), "w") as f:
+            json.dump(report, f, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(out_dir, profile_name))
+        return report
+
+    # text summary of the report and the top functions of the profile
+    def format_report(self, report=None, top=20):
+        if report is None: report = self.report()
+        lines = ["timing: {} samples, {} rendered, {:.3f} samples/s".format(
+            report["samples"], report["rendered"], report["samples_per_sec"])]
+        for name, stats in [("sample", report["sample"])] + list(report["stages"].items()):
+            lines.append("  {:<24} p50 {:8.4f}s  p95 {:8.4f}s  total {:9.3f}s".format(name, stats["p50"], stats["p95"], stats["total"]))
+        for name, stats in report["counters"].items():
+            lines.append("  {:<24} mean {:8.1f} per sample".format(name, stats["mean"]))
+        if self.profiler is not None and report["samples"] > 0:
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+            lines.append(stream.getvalue())
+        return "\n".join(lines)
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+from xml_tools import load_xml
+from array_store import person_to_arrays, write_shard, list_shards
+
+
+# function to list the xml files of a directory, sorted so the shard of every file is fixed
+def scan_xml(xml_dir):
+    return sorted(entry.name for entry in os.scandir(xml_dir) if entry.name.endswith(".xml") and entry.is_file())
+
+
+# function to convert one chunk of xml files into one shard, run in a worker process
+def convert_chunk(args):
+    xml_dir, file_names, shard_dir = args
+    boxes, body, hand, image_index, image_size, names, seeds, track_ids = [], [], [], [], [], [], [], []
+    failed = []
+    for file_name in file_names:
+        try:
+            img_name, img_size, objects, seed = load_xml(os.path.join(xml_dir, file_name))
+        except Exception as e:
+            failed.append((file_name, str(e)))
+            continue
+        for obj in objects:
+            bbox, b, h = person_to_arrays(obj)
+            boxes.append(bbox)
+            body.append(b)
+            hand.append(h)
+            image_index.append(len(names))
+            track_ids.append(obj.track_id)
+        image_size.append(img_size)
+        names.append(img_name)
+        seeds.append(seed)
+    write_shard(shard_dir, boxes, body, hand, image_index, image_size, names, seeds=seeds, track_ids=track_ids,
+                failed=[file_name for file_name, _ in failed])
+    return shard_dir, len(file_names), len(boxes), failed
+
+
+def convert(xml_dir, out_dir, shard_size=10000, workers=multiprocessing.cpu_count()):
+    os.makedirs(out_dir, exist_ok=True)
+    # the file list and shard size of the first run are kept, so a resumed run splits the files into the same shards
+    list_path = os.path.join(out_dir, "filelist.txt")
+    size_path = os.path.join(out_dir, "shard_size.txt")
+    if os.path.exists(list_path):
+        with open(list_path) as f:
+            file_names = f.read().split("\n")
+        file_names = [name for name in file_names if name]
+        previous = None
+        if os.path.exists(size_path):
+            with open(size_path) as f:
+                previous = int(f.read())
+        if previous is not None and previous != shard_size:
+            raise ValueError("{} was converted with shard size {}, rerun with --shard_size {} or use a new out_dir".format(
+                out_dir, previous, previous))
+        # the shards of a run without shard_size.txt can not be checked, only resume it if nothing is converted
+        if previous is None and list_shards(out_dir):
+            raise ValueError("{} has shards of an unknown shard size, use a new out_dir".format(out_dir))
+    else:
+        file_names = scan_xml(xml_dir)
+        with open(list_path + ".tmp", "w") as f:
+            f.write("\n".join(file_names))
+        os.rename(list_path + ".tmp", list_path)
+    if not os.path.exists(size_path):
+        with open(size_path, "w") as f:
+            f.write(str(shard_size))
+
+    # a shard with files that failed to parse is converted again, so a fixed or rewritten xml file is picked up
+    chunks = []
+    done, retry = set(), set()
+    for shard_dir in list_shards(out_dir):
+        with open(os.path.join(shard_dir, "meta.json")) as f:
+            failed = json.load(f).get("failed")
+        (retry if failed else done).add(os.path.basename(shard_dir))
+    for i, start in enumerate(range(0, len(file_names), shard_size)):
+        shard_name = "shard_{:05d}".format(i)
+        if shard_name in done: continue
+        chunks.append((xml_dir, file_names[start:start + shard_size], os.path.join(out_dir, shard_name)))
+
+    total = len(file_names)
+    converted = total - sum(len(chunk[1]) for chunk in chunks)
+    print("{} xml files, {} shards, {} files already converted".format(total, len(done) + len(chunks), converted))
+    if retry: print("retrying {} shards with failed files".format(len(retry)))
+    start = time.perf_counter()
+    count = 0
+    with multiprocessing.Pool(workers) as pool:
+        for shard_dir, num_files, num_persons, failed in pool.imap_unordered(convert_chunk, chunks):
+            count += num_files
+            for file_name, error in failed: print("failed to parse {}: {}".format(file_name, error))
+            use_time = time.perf_counter() - start
+            print("{}: {} files, {} persons, progress: {}/{}, {:.1f} files/s".format(
+                os.path.basename(shard_dir), num_files, num_persons, converted + count, total, count / use_time))
+
+    write_manifest(xml_dir, out_dir, shard_size)
+    return total
+
+
+# function to write the manifest of the converted dataset, one entry per shard
+# failed lists the xml files that could not be parsed, their shards are converted again by the next run
+def write_manifest(xml_dir, out_dir, shard_size):
+    shards = []
+    for shard_dir in list_shards(out_dir):
+        with open(os.path.join(shard_dir, "meta.json")) as f:
+            meta = json.load(f)
+        shards.append(dict(name=os.path.basename(shard_dir), **meta))
+    manifest = {
+        "source": os.path.abspath(xml_dir),
+        "shard_size": shard_size,
+        "images": sum(shard["images"] for shard in shards),
+        "persons": sum(shard["persons"] for shard in shards),
+        "failed": [file_name for shard in shards for file_name in shard.get("failed", [])],
+        "shards": shards,
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert a directory of xml annotations into array shards, rerun to resume")
+    parser.add_argument("xml_dir", help="directory of xml files written by xml_tools.save_xml")
+    parser.add_argument("out_dir", help="output directory of the array shards and manifest.json")
+    parser.add_argument("--shard_size", type=int, default=10000, help="xml files per shard")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    convert(args.xml_dir, args.out_dir, args.shard_size, args.workers)
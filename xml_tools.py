@@ -7,17 +7,23 @@ from collections import defaultdict
 
 import numpy as np
 
+from keypoints import *
+
 
 class Person():
-    def __init__(self, bbox, pose, hand):
+    def __init__(self, bbox, pose, hand, track_id=None):
         self.name = 'person'
         self.bbox = bbox
         self.pose = pose
         self.hand = hand
+        # id of the same person in every frame of a sequence, None outside of sequences
+        self.track_id = track_id
 
     def get_xml(self):
         xml_txt = """\t<object>\n"""
         xml_txt += """\t\t<name>""" + str(self.name) + """</name>\n"""
+        if self.track_id is not None:
+            xml_txt += """\t\t<track_id>""" + str(self.track_id) + """</track_id>\n"""
         xml_txt += """\t\t<pose>Unspecified</pose>\n"""
         x1, y1, x2, y2 = self.bbox
         if is_visible(x1, y1) and is_visible(x2, y2):
@@ -31,12 +37,39 @@ class Person():
         xml_txt += """\t</object>\n"""
         return xml_txt
 
+    # coco style annotation, bbox is [x, y, w, h] and keypoints are [x, y, v] * K in pixels
+    # v is 0 for missing keypoints, 1 for occluded or out of frame, 2 for visible
+    def get_coco(self, img_width, img_height):
+        xmin, ymin = max(0, self.bbox[0]) * img_width, max(0, self.bbox[1]) * img_height
+        xmax, ymax = min(1, self.bbox[2]) * img_width, min(1, self.bbox[3]) * img_height
+        keypoints = []
+        # LeftHand and RightHand are in both groups, look them up per group
+        for points, names in [(self.pose, body_labels), (self.hand, hand_bones)]:
+            for name in names:
+                if name not in points:
+                    keypoints += [0, 0, 0]
+                    continue
+                x, y, is_occluded = points[name]
+                v = 2 if is_visible(x, y) and not is_occluded else 1
+                keypoints += [round(x * img_width, 3), round(y * img_height, 3), v]
+        record = {
+            "category_id": 1,
+            "bbox": [round(xmin, 3), round(ymin, 3), round(xmax - xmin, 3), round(ymax - ymin, 3)],
+            "area": round((xmax - xmin) * (ymax - ymin), 3),
+            "iscrowd": 0,
+            "num_keypoints": sum(1 for v in keypoints[2::3] if v > 0),
+            "keypoints": keypoints,
+        }
+        if self.track_id is not None: record["track_id"] = self.track_id
+        return record
+
     def get_dict(self):
         return {
             "name": self.name,
             "bbox": self.bbox,
             "pose": self.pose,
             "hand": self.hand,
+            "track_id": self.track_id,
         }
 
 
@@ -87,7 +120,8 @@ def pose2xml(keypoints, label_name:str):
 
 
 # function to generate xml file
-def save_xml(objects:list, img_path:str, xml_path:str, img_width:int, img_height:int, img_channel:int):
+# seed is the sample seed, written if given so the sample can be generated again
+def save_xml(objects:list, img_path:str, xml_path:str, img_width:int, img_height:int, img_channel:int, seed:int=None):
     img_name = os.path.basename(img_path)
     xml_txt = """"""  # xml file text
     xml_txt += """<?xml version="1.0" encoding="UTF-8"?>\n"""
@@ -104,6 +138,8 @@ def save_xml(objects:list, img_path:str, xml_path:str, img_width:int, img_height
     xml_txt += """\t\t<depth>""" + str(img_channel) + """</depth>\n"""
     xml_txt += """\t</size>\n"""
     xml_txt += """\t<segmented>0</segmented>\n"""
+    if seed is not None:
+        xml_txt += """\t<seed>""" + str(seed) + """</seed>\n"""
 
     # add object
     for obj in objects:
@@ -116,3 +152,89 @@ def save_xml(objects:list, img_path:str, xml_path:str, img_width:int, img_height
     xml_file = os.path.join(xml_path, xml_name)
     with open(xml_file, "w") as f:
         f.write(xml_txt)
+
+
+# function to make the coco style record of one image
+def coco_record(objects:list, img_path:str, img_width:int, img_height:int, img_channel:int, seed:int=None):
+    image = {
+        "file_name": os.path.basename(img_path),
+        "width": img_width,
+        "height": img_height,
+        "depth": img_channel,
+    }
+    if seed is not None: image["seed"] = seed
+    return {
+        "image": image,
+        "annotations": [obj.get_coco(img_width, img_height) for obj in objects],
+    }
+
+
+# streaming writer of one json record per line
+# records are written in batches of batch_size, or only by flush if batch_size is None
+# a new shard is started when a shard reaches max_bytes
+class JsonlWriter():
+    def __init__(self, out_dir:str, prefix:str="annotations", batch_size:int=256, max_bytes:int=256 * 1024 * 1024):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.file = None
+        self.size = 0
+        # continue after the existing shards, never append to a shard of an earlier run
+        self.shard = len(glob.glob(os.path.join(out_dir, prefix + "_*.jsonl")))
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, record:dict):
+        self.buffer.append((json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+        if self.batch_size is not None and len(self.buffer) >= self.batch_size: self.flush()
+
+    def flush(self):
+        if not self.buffer: return
+        data = b"".join(self.buffer)
+        self.buffer = []
+        if self.file is None or (self.size > 0 and self.size + len(data) > self.max_bytes):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        if self.file is not None: self.file.close()
+        self.file = open(os.path.join(self.out_dir, "{}_{:05d}.jsonl".format(self.prefix, self.shard)), "ab")
+        self.shard += 1
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# function to parse a keypoint node of save_xml into {name: (x, y, occluded)}
+def xml2pose(node):
+    keypoints = {}
+    if node is None: return keypoints
+    for point in node:
+        keypoints[point.tag] = (float(point.find("x").text), float(point.find("y").text), int(point.find("occluded").text))
+    return keypoints
+
+
+# function to load an xml file written by save_xml
+# return image file name, (width, height, depth), list of Person and the sample seed, None if not written
+def load_xml(xml_file:str):
+    with open(xml_file, "rb") as f:
+        root = ET.fromstring(f.read())
+    size = root.find("size")
+    img_size = (int(size.find("width").text), int(size.find("height").text), int(size.find("depth").text))
+    objects = []
+    for obj in root.iter("object"):
+        bndbox = obj.find("bndbox")
+        bbox = [float(bndbox.find(tag).text) for tag in ["xmin", "ymin", "xmax", "ymax"]]
+        track_id = obj.find("track_id")
+        track_id = int(track_id.text) if track_id is not None else None
+        objects.append(Person(bbox, xml2pose(obj.find("body")), xml2pose(obj.find("hand")), track_id))
+    seed = root.find("seed")
+    seed = int(seed.text) if seed is not None else None
+    return root.find("filename").text, img_size, objects, seed